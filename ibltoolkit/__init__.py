@@ -31,11 +31,35 @@ bl_info = {
 
 if "bpy" in locals():
     import imp
+    imp.reload(panorama)
+    imp.reload(raycast)
+    imp.reload(bvh)
+    imp.reload(tiles)
+    imp.reload(imagefile)
+    imp.reload(proxy)
+    imp.reload(cubemap)
+    imp.reload(bake)
+    imp.reload(sampling)
+    imp.reload(sun)
+    imp.reload(irradiance)
+    imp.reload(composite)
     imp.reload(calibrate)
     imp.reload(edit)
     imp.reload(render)
 
 else:
+    from . import panorama
+    from . import raycast
+    from . import bvh
+    from . import tiles
+    from . import imagefile
+    from . import proxy
+    from . import cubemap
+    from . import bake
+    from . import sampling
+    from . import sun
+    from . import irradiance
+    from . import composite
     from . import calibrate
     from . import edit
     from . import render
@@ -78,8 +102,6 @@ class IBLSettings(bpy.types.PropertyGroup):
     hdr_file=StringProperty(name="HDR File", description="Use another HDR file instead. For Luxrender you can store the depth in the alpha channel", subtype='FILE_PATH')
     factor_file=StringProperty(name="Use a Depth Factor File", description="Depth influence map - HDR factor, calculated with/for Luxrender", subtype='FILE_PATH')
 
-    updating=IntProperty(name="Updating Flag", description="Hack flag to avoid recursiveness", default=0, min=0, max=2)
-
     vertex_0 = FloatVectorProperty(name="Vertex 0", subtype='XYZ', default=_3d_to_sphere( Vector((1.0, 1.0, 0.0)), (0,0,0), 1.0))
     vertex_1 = FloatVectorProperty(name="Vertex 1", subtype='XYZ', default=_3d_to_sphere( Vector((2.0, 1.0, 0.0)), (0,0,0), 1.0))
     vertex_2 = FloatVectorProperty(name="Vertex 2", subtype='XYZ', default=_3d_to_sphere( Vector((2.0, 2.0, 0.0)), (0,0,0), 1.0))
@@ -95,12 +117,23 @@ def register():
     bpy.types.Scene.orientation = FloatVectorProperty(subtype='EULER')
     bpy.types.Scene.ibl_image= StringProperty()
 
+    bpy.types.WindowManager.ibl_timings = BoolProperty(name="Frame Timings",
+            description="Record the time spent in every stage of the panorama background drawing")
+    bpy.types.WindowManager.ibl_timings_sync = BoolProperty(name="Sync GPU",
+            description="Wait for the GL calls to finish before timing every stage (slows the drawing down)")
+
+    calibrate.register_handlers()
+
 def unregister():
+    calibrate.unregister_handlers()
+    edit.free_gl()
     bpy.utils.unregister_module(__name__)
 
     del bpy.types.MovieClip.ibl_settings
     del bpy.types.Scene.orientation
     del bpy.types.Scene.ibl_image
+    del bpy.types.WindowManager.ibl_timings
+    del bpy.types.WindowManager.ibl_timings_sync
 
 if __name__ == '__main__':
     register()
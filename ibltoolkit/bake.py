@@ -0,0 +1,277 @@
+"""
+Baking of the calibrated panorama into new images.
+
+The panoramas are numpy (or memory-mapped) arrays stored top row first.
+The output pixels are mapped back to the panorama and resampled in
+tiles on a thread pool. No bpy, so it runs headless as well.
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from . import panorama
+from . import imagefile
+from . import tiles
+
+# output rows resampled by each job
+TILE_HEIGHT = 64
+
+# ###############################
+#  Floor Texture
+# ###############################
+
+def floor_texture(image, euler, camera_height, extent, resolution, center=(0.0, 0.0), threads=None):
+    """
+    orthographic top-down view of the floor (z = 0) as seen from the panorama
+    extent : (width, height) of the floor covered, in scene units
+    resolution : (width, height) of the texture, in pixels
+    center : floor point at the middle of the texture
+    returns a (height, width, channels) float32 array, top row first (+Y)
+    """
+    image = np.asarray(image)
+    width, height = resolution
+
+    texture = np.empty((height, width) + image.shape[2:], dtype=np.float32)
+    x = center[0] + ((np.arange(width) + 0.5) / width - 0.5) * extent[0]
+
+    def tile(start, end):
+        y = center[1] + (0.5 - (np.arange(start, end) + 0.5) / height) * extent[1]
+
+        points = np.zeros((end - start, width, 3))
+        points[:, :, 0] = x[None, :]
+        points[:, :, 1] = y[:, None]
+
+        # from the floor back to the camera, then to the panorama
+        verts = panorama._3d_to_sphere(points.reshape(-1, 3), euler, camera_height)
+        uv = panorama.sphere_to_equirectangular(panorama.normalize(verts))
+
+        texture[start:end] = panorama.sample_bilinear(image, uv).reshape(texture[start:end].shape)
+
+    jobs = [(start, min(start + TILE_HEIGHT, height)) for start in range(0, height, TILE_HEIGHT)]
+    tiles.run_threaded(tile, jobs, threads)
+
+    return texture
+
+# ###############################
+#  Upright Panorama
+# ###############################
+
+# source rows decoded at once, the unit of the row cache
+CHUNK_HEIGHT = 32
+
+# upright panorama columns resampled by each job
+TILE_WIDTH = 1024
+
+# memory for the decoded source rows shared by the jobs
+CACHE_SIZE = 512 * 1024 * 1024
+
+# memory for the jobs running or waiting to be written, about 128 bytes per pixel
+IN_FLIGHT_SIZE = 256 * 1024 * 1024
+JOB_PIXEL_SIZE = 128
+
+def upright_uv(width, height, euler, rows, columns=None):
+    """
+    uv in the calibrated panorama of the upright panorama pixels
+    rows : (start, end) rows of the upright panorama, from the top
+    columns : (start, end) columns, all of them by default
+    returns a (N,2) array
+    """
+    start, end = rows
+    left, right = columns or (0, width)
+
+    uv = np.empty((end - start, right - left, 2))
+    uv[:, :, 0] = ((np.arange(left, right) + 0.5) / width)[None, :]
+    uv[:, :, 1] = (1.0 - (np.arange(start, end) + 0.5) / height)[:, None]
+
+    # world directions back to the panorama sphere, the inverse rotation
+    verts = panorama.equirectangular_to_sphere(uv.reshape(-1, 2)).dot(panorama.euler_to_matrix(euler))
+    return panorama.sphere_to_equirectangular(verts)
+
+def source_rows(uv, height):
+    """(start, end) panorama rows, from the top, covering the bilinear lookup of uv"""
+    y = (1.0 - uv[:, 1]) * height - 0.5
+    start = int(np.clip(np.floor(y.min()), 0, height - 1))
+    end = int(np.clip(np.floor(y.max()) + 2, start + 1, height))
+    return start, end
+
+def first_source_rows(height, euler, bands, source_height, columns=256):
+    """
+    first source row needed by every band and the ones after it,
+    estimated on a few columns, with a margin
+    """
+    first = [source_rows(upright_uv(columns, height, euler, rows), source_height)[0] - 2 \
+            for rows in bands]
+
+    # a band can need rows above the ones of the band before it
+    for i in range(len(first) - 2, -1, -1):
+        first[i] = min(first[i], first[i + 1])
+
+    return first
+
+class _Chunk:
+    """rows of a chunk, set by the thread decoding it"""
+    def __init__(self):
+        self.ready = threading.Event()
+        self.rows = None
+
+class RowCache:
+    """
+    decoded rows of a panorama reader or array, in chunks of CHUNK_HEIGHT
+    rows shared by the jobs, every chunk is decoded once while it is kept
+
+    release() slides the window down, dropping the chunks no job needs any
+    more. Over max_size the least recently used chunks are dropped as well,
+    they are decoded again if needed.
+    """
+    def __init__(self, source, max_size=CACHE_SIZE):
+        self.read_rows, self.width, self.height = imagefile.row_reader(source)
+        self.max_chunks = max(1, max_size // (CHUNK_HEIGHT * self.width * 3 * 4))
+        self.decoded = 0
+
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def chunk(self, index):
+        """(CHUNK_HEIGHT, width, 3) float32 rows of the chunk, the last one can be shorter"""
+        with self._lock:
+            chunk = self._chunks.get(index)
+
+            if chunk:
+                self._chunks.move_to_end(index)
+                decode = False
+
+            else:
+                chunk = self._chunks[index] = _Chunk()
+                decode = True
+
+                while len(self._chunks) > self.max_chunks:
+                    self._chunks.popitem(last=False)
+
+        if not decode:
+            chunk.ready.wait()
+            if chunk.rows is None:
+                # the decoding thread failed, try again
+                return self.chunk(index)
+            return chunk.rows
+
+        start = index * CHUNK_HEIGHT
+        end = min(start + CHUNK_HEIGHT, self.height)
+
+        try:
+            chunk.rows = np.asarray(self.read_rows(start, end)[:, :, :3], dtype=np.float32)
+
+        finally:
+            if chunk.rows is None:
+                with self._lock:
+                    if self._chunks.get(index) is chunk:
+                        del self._chunks[index]
+            chunk.ready.set()
+
+        with self._lock:
+            self.decoded += end - start
+
+        return chunk.rows
+
+    def release(self, first_row):
+        """drop the chunks above first_row"""
+        with self._lock:
+            for index in list(self._chunks):
+                if (index + 1) * CHUNK_HEIGHT <= first_row:
+                    del self._chunks[index]
+
+    def gather(self, rows, columns):
+        """(N,3) pixels at the rows and columns, fetched a chunk at a time"""
+        pixels = np.empty((len(rows), 3), dtype=np.float32)
+        chunks = rows // CHUNK_HEIGHT
+
+        order = np.argsort(chunks, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(chunks[order])) + 1
+
+        for group in np.split(order, bounds):
+            index = chunks[group[0]]
+            pixels[group] = self.chunk(index)[rows[group] - index * CHUNK_HEIGHT, columns[group]]
+
+        return pixels
+
+    def sample_bilinear(self, uv):
+        """panorama.sample_bilinear of the (N,2) uv, with the rows from the cache"""
+        x = uv[:, 0] * self.width - 0.5
+        y = (1.0 - uv[:, 1]) * self.height - 0.5
+
+        x0 = np.floor(x)
+        y0 = np.floor(y)
+
+        fx = (x - x0).astype(np.float32)[:, None]
+        fy = (y - y0).astype(np.float32)[:, None]
+
+        x0 = x0.astype(np.int64) % self.width
+        x1 = (x0 + 1) % self.width
+        y1 = np.clip(y0.astype(np.int64) + 1, 0, self.height - 1)
+        y0 = np.clip(y0.astype(np.int64), 0, self.height - 1)
+
+        top = self.gather(y0, x0) * (1.0 - fx) + self.gather(y0, x1) * fx
+        bottom = self.gather(y1, x0) * (1.0 - fx) + self.gather(y1, x1) * fx
+
+        return top * (1.0 - fy) + bottom * fy
+
+def upright_panorama(source, writer, euler, band_height=TILE_HEIGHT, threads=None, progress=None, \
+        cache_size=CACHE_SIZE):
+    """
+    resample the calibrated panorama so its orientation becomes (0, 0, 0),
+    streaming it to the writer a band at a time
+    source : imagefile reader, or a (height, width, channels) numpy/memmap array
+    writer : imagefile writer, of any size
+    progress : called with the number of rows written so far
+    cache_size : memory for the decoded source rows
+
+    the bands are resampled in tiles of TILE_WIDTH columns, from a sliding
+    window of decoded source rows: every row is decoded once as long as the
+    rows a band spans (more with the tilt) fit in the cache
+    returns the number of source rows decoded
+    """
+    cache = RowCache(source, cache_size)
+    width, height = writer.width, writer.height
+
+    bands = [(start, min(start + band_height, height)) for start in range(0, height, band_height)]
+    columns = [(left, min(left + TILE_WIDTH, width)) for left in range(0, width, TILE_WIDTH)]
+    first_rows = first_source_rows(height, euler, bands, cache.height) + [cache.height]
+
+    def tile(start, end, left, right):
+        uv = upright_uv(width, height, euler, (start, end), (left, right))
+        return cache.sample_bilinear(uv).reshape(end - start, right - left, 3)
+
+    # every other band goes right to left, it starts with the rows the band before just used
+    jobs = []
+    for i, (start, end) in enumerate(bands):
+        for left, right in (columns[::-1] if i % 2 else columns):
+            jobs.append((start, end, left, right))
+
+    # bound the tiles in flight by their memory, but keep all the threads busy
+    threads = threads or tiles.cpu_count()
+    job_size = band_height * min(TILE_WIDTH, width) * JOB_PIXEL_SIZE
+    ahead = max(threads, IN_FLIGHT_SIZE // job_size)
+
+    band = 0
+    done = 0
+    pixels = np.empty((band_height, width, 3), dtype=np.float32)
+
+    for (start, end, left, right), tile_pixels in zip(jobs, tiles.map_threaded(tile, jobs, threads, ahead)):
+        pixels[:end - start, left:right] = tile_pixels
+        done += 1
+
+        if done < len(columns):
+            continue
+
+        writer.write(pixels[:end - start])
+        band += 1
+        done = 0
+
+        # the tiles still running belong to the next bands
+        cache.release(first_rows[band])
+
+        if progress:
+            progress(end)
+
+    return cache.decoded
@@ -0,0 +1,279 @@
+"""
+Bounding volume hierarchy for the support geometry.
+
+Binned SAH build over (T,3,3) triangle arrays, stored as flat arrays
+(one entry per node) so it can be shared between processes. Rays are
+traversed in batches: every node is tested against all the rays that
+reached it at once.
+"""
+
+import numpy as np
+
+from .raycast import ray_triangle, triangle_edges
+
+class BVH:
+    """
+    flattened bounding volume hierarchy
+
+    bounds_min, bounds_max : (N,3) node bounding boxes
+    child : index of the left child, the right child is child + 1
+    first, count : triangle range of the leaves (count is 0 for inner nodes)
+    axis : split axis of the inner nodes
+    v0, e1, e2 : triangles sorted by leaf (see raycast.ray_triangle)
+    triangle : original index of the sorted triangles
+    """
+    ARRAYS = ('bounds_min', 'bounds_max', 'child', 'first', 'count', 'axis', 'v0', 'e1', 'e2', 'triangle')
+
+    def __init__(self, **arrays):
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    def arrays(self):
+        """dictionary with all the arrays needed to recreate the BVH"""
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    @classmethod
+    def build(cls, triangles, leaf_size=8, bins=16):
+        """build the hierarchy of a (T,3,3) triangles array"""
+        return cls(**build_arrays(triangles, leaf_size, bins))
+
+    def __len__(self):
+        return len(self.triangle)
+
+    def intersect(self, origins, directions, t_max=np.inf):
+        """
+        closest hit of (N,3) rays
+        returns the (N,) distances (inf for no hit) and the triangle index (-1)
+        """
+        origins, directions = _rays(origins, directions)
+
+        distance = np.full(len(directions), t_max, dtype=np.float64)
+        index = np.full(len(directions), -1, dtype=np.int64)
+
+        for rays, first, count in self._leaves(origins, directions, distance):
+            tris = slice(first, first + count)
+
+            t = ray_triangle(origins[rays, None], directions[rays, None], \
+                    self.v0[None, tris], self.e1[None, tris], self.e2[None, tris])
+
+            closest = np.argmin(t, axis=1)
+            t = t[np.arange(len(t)), closest]
+
+            better = t < distance[rays]
+            distance[rays[better]] = t[better]
+            index[rays[better]] = self.triangle[first + closest[better]]
+
+        distance[index == -1] = np.inf
+        return distance, index
+
+    def occluded(self, origins, directions, t_max=np.inf):
+        """
+        any hit of (N,3) rays closer than t_max
+        returns a (N,) boolean array
+        """
+        origins, directions = _rays(origins, directions)
+
+        distance = np.empty(len(directions), dtype=np.float64)
+        distance[:] = t_max
+        hit = np.zeros(len(directions), dtype=bool)
+
+        for rays, first, count in self._leaves(origins, directions, distance):
+            tris = slice(first, first + count)
+
+            t = ray_triangle(origins[rays, None], directions[rays, None], \
+                    self.v0[None, tris], self.e1[None, tris], self.e2[None, tris])
+
+            blocked = rays[(t < distance[rays, None]).any(axis=1)]
+            hit[blocked] = True
+
+            # no need to keep traversing with those
+            distance[blocked] = -np.inf
+
+        return hit
+
+    def _leaves(self, origins, directions, distance):
+        """
+        traverse the hierarchy with all the rays at once
+        yields the rays that reach each leaf, with the leaf triangle range
+        distance is read during the traversal to cull the nodes behind the hits
+        """
+        if not len(self.triangle):
+            return
+
+        with np.errstate(divide='ignore'):
+            inv_directions = 1.0 / directions
+
+        stack = [(0, np.arange(len(directions)))]
+
+        while stack:
+            node, rays = stack.pop()
+
+            near, far = _slabs(origins[rays], inv_directions[rays], \
+                    self.bounds_min[node], self.bounds_max[node])
+
+            rays = rays[(near <= far) & (far >= 0.0) & (near < distance[rays])]
+            if not len(rays):
+                continue
+
+            count = self.count[node]
+            if count:
+                yield rays, self.first[node], count
+                continue
+
+            # visit first the child closer to the rays origin
+            left = self.child[node]
+            if directions[rays, self.axis[node]].sum() < 0.0:
+                stack.append((left, rays))
+                stack.append((left + 1, rays))
+            else:
+                stack.append((left + 1, rays))
+                stack.append((left, rays))
+
+# ###############################
+#  Build
+# ###############################
+
+def build_arrays(triangles, leaf_size=8, bins=16):
+    """binned surface area heuristic build, returns the BVH arrays"""
+    triangles = np.asarray(triangles, dtype=np.float64).reshape(-1, 3, 3)
+    total = len(triangles)
+
+    tri_min = triangles.min(axis=1)
+    tri_max = triangles.max(axis=1)
+    centroid = (tri_min + tri_max) * 0.5
+
+    order = np.arange(total)
+
+    size = max(1, 2 * total - 1)
+    bounds_min = np.zeros((size, 3))
+    bounds_max = np.zeros((size, 3))
+    child = np.zeros(size, dtype=np.int64)
+    first = np.zeros(size, dtype=np.int64)
+    count = np.zeros(size, dtype=np.int64)
+    axis = np.zeros(size, dtype=np.int8)
+
+    nodes = 1
+    stack = [(0, 0, total)] if total else []
+
+    while stack:
+        node, start, end = stack.pop()
+        ids = order[start:end]
+
+        bounds_min[node] = tri_min[ids].min(axis=0)
+        bounds_max[node] = tri_max[ids].max(axis=0)
+
+        split = None
+        if end - start > leaf_size:
+            split = _split(ids, tri_min, tri_max, centroid, bounds_min[node], bounds_max[node], bins, 4 * leaf_size)
+
+        if split is None:
+            first[node] = start
+            count[node] = end - start
+            continue
+
+        split_axis, left_ids, right_ids = split
+        order[start:end] = np.concatenate((left_ids, right_ids))
+        middle = start + len(left_ids)
+
+        axis[node] = split_axis
+        child[node] = nodes
+        stack.append((nodes, start, middle))
+        stack.append((nodes + 1, middle, end))
+        nodes += 2
+
+    if not total:
+        nodes = 0
+
+    v0, e1, e2 = triangle_edges(triangles[order])
+
+    return {
+        'bounds_min': bounds_min[:nodes],
+        'bounds_max': bounds_max[:nodes],
+        'child': child[:nodes],
+        'first': first[:nodes],
+        'count': count[:nodes],
+        'axis': axis[:nodes],
+        'v0': v0,
+        'e1': e1,
+        'e2': e2,
+        'triangle': order,
+        }
+
+def _split(ids, tri_min, tri_max, centroid, node_min, node_max, bins, max_leaf):
+    """
+    best SAH split of the triangles
+    returns the axis and the triangles of each side, None to make a leaf
+    """
+    centroids = centroid[ids]
+    low = centroids.min(axis=0)
+    extent = centroids.max(axis=0) - low
+
+    best_cost, best = np.inf, None
+
+    for split_axis in range(3):
+        if extent[split_axis] <= 0.0:
+            continue
+
+        bin_id = ((centroids[:, split_axis] - low[split_axis]) * (bins / extent[split_axis])).astype(np.int64)
+        np.minimum(bin_id, bins - 1, out=bin_id)
+
+        sort = np.argsort(bin_id, kind='mergesort')
+        sorted_bins = bin_id[sort]
+        used = np.flatnonzero(np.diff(np.concatenate(([-1], sorted_bins))))
+
+        # per bin bounds and counts, then swept from both sides
+        bin_min = np.minimum.reduceat(tri_min[ids[sort]], used)
+        bin_max = np.maximum.reduceat(tri_max[ids[sort]], used)
+        bin_count = np.diff(np.append(used, len(ids)))
+
+        left_area = _area(np.minimum.accumulate(bin_min), np.maximum.accumulate(bin_max))
+        right_area = _area(np.minimum.accumulate(bin_min[::-1])[::-1], np.maximum.accumulate(bin_max[::-1])[::-1])
+        left_count = np.cumsum(bin_count)
+        right_count = len(ids) - left_count
+
+        # splitting after used bin i
+        cost = left_area[:-1] * left_count[:-1] + right_area[1:] * right_count[:-1]
+        if not len(cost):
+            continue
+
+        i = np.argmin(cost)
+        if cost[i] < best_cost:
+            best_cost = cost[i]
+            best = split_axis, ids[sort[:left_count[i]]], ids[sort[left_count[i]:]]
+
+    if best is None:
+        # all the centroids are in the same spot, split in half
+        half = len(ids) // 2
+        return 0, ids[:half], ids[half:]
+
+    # a leaf is cheaper than the split
+    if best_cost >= _area(node_min, node_max) * len(ids) and len(ids) <= max_leaf:
+        return None
+
+    return best
+
+def _area(bounds_min, bounds_max):
+    """half the surface area of the boxes"""
+    size = np.maximum(bounds_max - bounds_min, 0.0)
+    return size[..., 0] * size[..., 1] + size[..., 1] * size[..., 2] + size[..., 2] * size[..., 0]
+
+# ###############################
+#  Traversal
+# ###############################
+
+def _rays(origins, directions):
+    """(N,3) float64 origins and directions"""
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    origins = np.broadcast_to(np.asarray(origins, dtype=np.float64), directions.shape)
+    return origins, directions
+
+def _slabs(origins, inv_directions, bounds_min, bounds_max):
+    """entry and exit distances of the rays in a box"""
+    with np.errstate(invalid='ignore'):
+        t0 = (bounds_min - origins) * inv_directions
+        t1 = (bounds_max - origins) * inv_directions
+
+    # nan comes from 0 * inf, rays parallel to and on the slab plane
+    near = np.fmax.reduce(np.fmin(t0, t1), axis=1)
+    far = np.fmin.reduce(np.fmax(t0, t1), axis=1)
+    return near, far
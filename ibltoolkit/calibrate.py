@@ -1,11 +1,20 @@
 # TODO LIST
 # - fix rectangle drawing code
-# - set sun
 # - Draw feedback (axes, reprojected square)
 
+import os
+
 import bpy
+from bpy.app.handlers import persistent
 from mathutils import Vector, Matrix, Euler
-from math import (sin, cos, pi, acos, asin, atan2, radians, degrees, sqrt)
+from math import (sin, cos, tan, pi, acos, asin, atan2, radians, degrees, sqrt)
+
+import numpy as np
+
+from . import panorama
+from . import imagefile
+from . import proxy
+from . import sun
 
 # ###############################
 #  Property Update Routines
@@ -24,66 +33,21 @@ def update_width(self, context):
     update height and camera according
     to width, and update draw
     """
-    movieclip = context.edit_movieclip
-    settings = movieclip.ibl_settings
-
-    # hack to avoid recursiveness
-    if settings.updating:
-        settings.updating -= 1
-        return
-
-    v0 = sphere_to_3d(settings.vertex_0, settings.orientation, settings.camera_height)
-    v1 = sphere_to_3d(settings.vertex_1, settings.orientation, settings.camera_height)
-
-    distance = (v0-v1).length
-    factor = settings.plane_width / distance
-
-    settings.camera_height *= factor
+    solve_settings(context, 'plane_width')
 
 def update_height(self, context):
     """
     update width and camera according
     to height, and update draw
     """
-    movieclip = context.edit_movieclip
-    settings = movieclip.ibl_settings
-
-    # hack to avoid recursiveness
-    if settings.updating:
-        settings.updating -= 1
-        return
-
-    v1 = sphere_to_3d(settings.vertex_1, settings.orientation, settings.camera_height)
-    v2 = sphere_to_3d(settings.vertex_2, settings.orientation, settings.camera_height)
-
-    distance = (v1-v2).length
-    factor = settings.plane_height / distance
-
-    settings.camera_height *= factor
+    solve_settings(context, 'plane_height')
 
 def update_camera(self, context):
     """
     update width and height according
     to camera height, and update draw
     """
-    movieclip = context.edit_movieclip
-    settings = movieclip.ibl_settings
-
-    # hack to avoid recursiveness
-    if settings.updating:
-        settings.updating -= 1
-        return
-    else:
-        settings.updating = 2
-
-    v0 = sphere_to_3d(settings.vertex_0, settings.orientation, settings.camera_height)
-    v1 = sphere_to_3d(settings.vertex_1, settings.orientation, settings.camera_height)
-    v2 = sphere_to_3d(settings.vertex_2, settings.orientation, settings.camera_height)
-
-    settings.plane_width = (v0-v1).length
-    settings.plane_height = (v1-v2).length
-
-    draw_3d_update(self, context)
+    solve_settings(context, 'camera_height')
 
 def update_orientation(self, context):
     """
@@ -95,12 +59,13 @@ def update_orientation(self, context):
     settings = movieclip.ibl_settings
 
     if settings.use_auto_background:
-        bpy.ops.clip.background_ibl()
+        if background_target(scene):
+            request_background_update(context)
+        else:
+            # first time, the world or light needs to be setup
+            bpy.ops.clip.background_ibl()
 
-    if settings.reference == 'CAMERA':
-        update_camera(self, context)
-    else:
-        update_width(self, context)
+    solve_settings(context, 'orientation')
 
 def draw_3d_update(self, context):
     """update calibration object drawing (floor) + camera and light height"""
@@ -114,7 +79,109 @@ def draw_3d_update(self, context):
         object=bpy.data.objects.get("IBL Light")
         if object: object.location = (0, 0, settings.camera_height)
 
-    bpy.ops.clip.draw_ibl_markers()
+    draw_floor(scene, settings)
+
+# ###############################
+#  Settings Propagation
+# ###############################
+
+# movieclips being solved, the updates fired by the solver itself are ignored
+_solving = set()
+
+def plane_factors(settings):
+    """plane width and height for a camera height of 1.0, they scale linearly with it"""
+    verts = (settings.vertex_0[:], settings.vertex_1[:], settings.vertex_2[:])
+    v0, v1, v2 = panorama.sphere_to_3d(verts, settings.orientation, 1.0)
+    return np.linalg.norm(v0 - v1), np.linalg.norm(v1 - v2)
+
+def solve_settings(context, changed):
+    """
+    recompute the settings depending on the changed one, then redraw once
+    changed : 'orientation', 'camera_height', 'plane_width' or 'plane_height'
+
+    the camera height drives the plane dimensions, a new orientation keeps
+    the camera height or the plane width depending on the reference method
+    """
+    movieclip = context.edit_movieclip
+    settings = movieclip.ibl_settings
+
+    if movieclip.name in _solving:
+        return
+
+    width, height = plane_factors(settings)
+
+    if changed == 'orientation':
+        changed = 'camera_height' if settings.reference == 'CAMERA' else 'plane_width'
+
+    camera_height = settings.camera_height
+    if changed == 'plane_width' and width > 0.0:
+        camera_height = settings.plane_width / width
+    elif changed == 'plane_height' and height > 0.0:
+        camera_height = settings.plane_height / height
+
+    _solving.add(movieclip.name)
+    try:
+        settings.camera_height = camera_height
+
+        # read it back, the property clamps it
+        camera_height = settings.camera_height
+        settings.plane_width = camera_height * width
+        settings.plane_height = camera_height * height
+
+    finally:
+        _solving.discard(movieclip.name)
+
+    draw_3d_update(None, context)
+
+# ###############################
+#  Live Background Update
+# ###############################
+
+# (scene, movieclip) names waiting for their orientation to be pushed
+# to the background, flushed once by flush_background_update
+_background_pending = set()
+
+def background_target(scene):
+    """the node or object holding the background rotation, None if not setup yet"""
+    if scene.render.engine == 'CYCLES':
+        world = scene.world
+        if not (world and world.use_nodes and world.node_tree): return None
+        return world.node_tree.nodes.get("IBL Environment Texture")
+
+    elif scene.render.engine == 'LUXRENDER_RENDER':
+        return bpy.data.objects.get("IBL Light")
+
+    return None
+
+def set_background_rotation(scene, settings):
+    """only push the orientation, the image and the links are left alone"""
+    target = background_target(scene)
+    if not target: return
+
+    orientation = settings.orientation
+    scene.orientation = orientation
+
+    if scene.render.engine == 'CYCLES':
+        target.texture_mapping.rotation = (-orientation[0], -orientation[1], -orientation[2])
+
+    else:
+        # Blender to LuxRender orientation convertion
+        target.rotation_euler = orientation[0] + pi, orientation[1], orientation[2]
+
+def request_background_update(context):
+    """queue the background rotation, applied once after the property updates"""
+    _background_pending.add((context.scene.name, context.edit_movieclip.name))
+
+@persistent
+def flush_background_update(scene):
+    """scene_update_post handler, apply the queued rotations outside of the drawing"""
+    while _background_pending:
+        scene_name, movieclip_name = _background_pending.pop()
+        scene = bpy.data.scenes.get(scene_name)
+        movieclip = bpy.data.movieclips.get(movieclip_name)
+
+        if scene and movieclip:
+            set_background_rotation(scene, movieclip.ibl_settings)
 
 # ###############################
 #  Geometry Functions
@@ -126,28 +193,13 @@ def equirectangular_to_sphere(uv):
     uv : 0,0 (bottom left) 1,1 (top right)
     uv : +pi, -pi/2 (bottom left) -pi, +pi/2 (top right)
     """
-    u,v = uv
-
-    phi = (0.5 - u) * 2 * pi
-    theta = (v - 0.5) * pi
-    r = cos(theta)
-
-    x = cos(phi) * r
-    y = sin(phi) * r
-    z = sin(theta)
-
-    return Vector((x,y,z))
+    return Vector(panorama.equirectangular_to_sphere(uv[:2])[0])
 
 def sphere_to_equirectangular(vert):
     """
     convert a 3d point to uv
     """
-    theta = asin(vert.z)
-    phi = atan2(vert.y, vert.x)
-
-    u = -0.5 * (phi / pi -1)
-    v = 0.5 * (2 * theta / pi + 1)
-
+    u, v = panorama.sphere_to_equirectangular(vert[:3])[0]
     return u, v
 
 def sphere_to_euler(vecx, vecy, vecz):
@@ -162,33 +214,14 @@ def sphere_to_3d(vert, euler, radius):
     given a point in the sphere and the euler inclination of the pole
     calculatest he projected point in the plane
     """
-    M = euler.to_matrix()
-    vert = M * vert
-    vert *= radius
-
-    origin = Vector((0,0,radius))
-    vert +=  origin
-    vector = vert - origin
-
-#    t = (0 - origin[2]) / vector[2]
-    t = - radius / (vert[2] - radius)
-
-    floor = origin + t * vector
-    return floor
+    return Vector(panorama.sphere_to_3d(vert[:3], euler, radius)[0])
 
 def _3d_to_sphere(vert, euler, radius):
     """
     given a point in the sphere and the euler inclination of the pole
     calculatest he projected point in the plane
     """
-    origin = Vector((0,0,radius))
-    vert -= origin
-    vert /= radius
-
-    M = Euler(euler).to_matrix().inverted()
-    vert = M * vert
-
-    return vert
+    return Vector(panorama._3d_to_sphere(vert[:3], euler, radius)[0])
 
 def intersect_lines(p0, v0, p1, v1):
     """
@@ -244,36 +277,286 @@ def convex_hull(verts):
 
     return ids
 
+# ###############################
+#  Track Selection Cache
+# ###############################
+
+# the operators poll run on every panel redraw, they all share one
+# scan of the tracks, keyed by the select and hide flags of the tracks
+# only track indices are kept, RNA pointers don't survive undo
+_selection = {}
+
+def track_selection(movieclip):
+    """
+    tracks of the active tracking object and the (visible, all)
+    indices of the selected ones
+    """
+    index = movieclip.tracking.active_object_index
+    tracks = movieclip.tracking.objects[index].tracks
+
+    select = [False] * len(tracks)
+    hide = [False] * len(tracks)
+    tracks.foreach_get('select', select)
+    tracks.foreach_get('hide', hide)
+
+    key = (movieclip.as_pointer(), index, tuple(select), tuple(hide))
+
+    if key not in _selection:
+        _selection.clear()
+
+        selected = [i for i, flag in enumerate(select) if flag]
+        _selection[key] = [i for i in selected if not hide[i]], selected
+
+    visible, selected = _selection[key]
+    return tracks, visible, selected
+
+@persistent
+def clear_track_selection(dummy):
+    """undo_post and load_post handler, the data may be at new addresses"""
+    _selection.clear()
+
 # ###############################
 #  Utility Functions
 # ###############################
-def selected_tracks(movieclip):
-    """returns all the visible selected tracks of the active tracking object"""
+def selected_tracks(movieclip, hidden=False):
+    """
+    returns all the visible selected tracks of the active tracking object
+    hidden : include the hidden selected tracks as well
+    """
     if not movieclip: return []
 
-    tracking = movieclip.tracking.objects[movieclip.tracking.active_object_index]
-    selected_tracks = []
-    for track in tracking.tracks:
-        if track.select and not track.hide:
-            selected_tracks.append(track)
-
-    return selected_tracks
+    tracks, visible, selected = track_selection(movieclip)
+    return [tracks[i] for i in (selected if hidden else visible)]
 
 def get_image(imagepath, fake_user=True):
     """get blender image for a given path, or load one"""
-    image = None
+    global _image_count
 
-    for img in bpy.data.images:
-      if img.filepath == imagepath:
-        image=img
-        break
+    key = image_key(imagepath)
+    image = find_image(key)
 
     if not image:
       image=bpy.data.images.load(imagepath)
       image.use_fake_user = fake_user
 
+      _image_index[key] = image.name
+      _image_count = len(bpy.data.images)
+
     return image
 
+# image names by normalized filepath, see find_image
+_image_index = {}
+_image_count = -1
+
+def image_key(imagepath):
+    """normalized absolute path, the same for relative and absolute paths"""
+    return os.path.normcase(os.path.normpath(bpy.path.abspath(imagepath)))
+
+def index_images():
+    """rebuild the image index"""
+    global _image_count
+
+    _image_index.clear()
+    for img in bpy.data.images:
+        if img.filepath:
+            _image_index.setdefault(image_key(img.filepath), img.name)
+
+    _image_count = len(bpy.data.images)
+
+def find_image(key):
+    """
+    blender image with the normalized filepath, None if there is none
+    the index is rebuilt when images are added or removed, or when the
+    indexed image was renamed or reloaded from another file
+    """
+    if _image_count != len(bpy.data.images):
+        index_images()
+
+    image = _indexed_image(key)
+    if not image:
+        index_images()
+        image = _indexed_image(key)
+
+    return image
+
+def _indexed_image(key):
+    name = _image_index.get(key)
+    image = bpy.data.images.get(name) if name else None
+
+    if image and image_key(image.filepath) == key:
+        return image
+
+    return None
+
+HDR_EXTENSIONS = ('.hdr', '.exr')
+
+_proxy_cache = None
+
+def get_proxy_cache():
+    """disk cache of the LDR proxies, in the user data folder"""
+    global _proxy_cache
+
+    if not _proxy_cache:
+        directory = bpy.utils.user_resource('DATAFILES', path="ibltoolkit_proxies", create=True)
+        _proxy_cache = proxy.ProxyCache(directory)
+
+    return _proxy_cache
+
+def get_viewport_image_path(imagepath):
+    """
+    LDR image to use in the 3d view, the image itself or its cached proxy for HDRs
+    the proxy is generated in the background, returns None until it is ready
+    """
+    filepath = bpy.path.abspath(imagepath)
+
+    if os.path.splitext(filepath)[1].lower() not in HDR_EXTENSIONS:
+        return imagepath
+
+    if not os.path.exists(filepath):
+        return None
+
+    future = proxy.request(get_proxy_cache(), filepath)
+    if future.done() and not future.exception():
+        return future.result()
+
+    return None
+
+def get_analysis_pixels(imagepath):
+    """
+    (height, width, 3) float proxy of an HDR for the sun and irradiance estimation
+    generated in the background, returns None until it is ready and for the other formats
+    """
+    filepath = bpy.path.abspath(imagepath)
+
+    if os.path.splitext(filepath)[1].lower() not in HDR_EXTENSIONS:
+        return None
+
+    if not os.path.exists(filepath):
+        return None
+
+    future = proxy.request_float(get_proxy_cache(), filepath)
+    if future.done() and not future.exception():
+        return np.load(future.result())
+
+    return None
+
+# scenes showing an HDR in the 3d view until its proxy is ready, by name
+_proxy_pending = {}
+
+def set_viewport_image(scene, imagepath):
+    """
+    set the 3d view background image (scene.ibl_image),
+    an HDR is swapped for its proxy by swap_ready_proxies once generated
+    """
+    viewport_path = get_viewport_image_path(imagepath)
+    scene.ibl_image = get_image(viewport_path or imagepath).name
+
+    if viewport_path is None and os.path.exists(bpy.path.abspath(imagepath)):
+        _proxy_pending[scene.name] = proxy.request(get_proxy_cache(), bpy.path.abspath(imagepath))
+    else:
+        _proxy_pending.pop(scene.name, None)
+
+@persistent
+def swap_ready_proxies(scene):
+    """scene_update_post handler, points ibl_image to the proxies done since the last call"""
+    if not _proxy_pending: return
+
+    for name, future in list(_proxy_pending.items()):
+        if not future.done(): continue
+        del _proxy_pending[name]
+
+        scene = bpy.data.scenes.get(name)
+        if not scene or future.cancelled() or future.exception(): continue
+
+        scene.ibl_image = get_image(future.result()).name
+
+        for window in bpy.context.window_manager.windows:
+            for area in window.screen.areas:
+                if area.type == 'VIEW_3D':
+                    area.tag_redraw()
+
+def get_panorama(imagepath):
+    """
+    memory-mapped reader for a Radiance or OpenEXR panorama,
+    decodes rows on demand, None for the other formats
+    and the files it can't decode (e.g. PIZ or DWA compressed EXR),
+    the callers fall back to get_image then
+    """
+    filepath = bpy.path.abspath(imagepath)
+
+    if os.path.splitext(filepath)[1].lower() not in HDR_EXTENSIONS:
+        return None
+
+    try:
+        return imagefile.open_image(filepath)
+    except (ValueError, IOError, OSError):
+        return None
+
+def panorama_pixels(imagepath):
+    """
+    (height, width, channels) float32 pixels of the panorama, top row first
+    returns None if the image can't be loaded
+    """
+    reader = get_panorama(imagepath)
+
+    if reader:
+        try:
+            return reader.read_rows(0, reader.height)
+        finally:
+            reader.close()
+
+    image = get_image(imagepath, fake_user=False)
+    if not image:
+        return None
+
+    return image_pixels(image)
+
+def image_pixels(image):
+    """(height, width, channels) float32 pixels of a Blender image, top row first"""
+    width, height = image.size
+    pixels = np.empty(width * height * image.channels, dtype=np.float32)
+
+    # one bulk copy, slicing image.pixels goes through the whole array every time
+    if hasattr(image.pixels, "foreach_get"):
+        image.pixels.foreach_get(pixels)
+    else:
+        pixels[:] = image.pixels[:]
+
+    # blender rows go from the bottom up
+    return pixels.reshape(height, width, image.channels)[::-1]
+
+# ###############################
+#  Handlers
+# ###############################
+
+# (bpy.app.handlers list, function) of the application handlers
+APP_HANDLERS = (
+    ('scene_update_post', flush_background_update),
+    ('scene_update_post', swap_ready_proxies),
+    ('undo_post', clear_track_selection),
+    ('load_post', clear_track_selection),
+    )
+
+def register_handlers():
+    """add the handlers, calling it again does nothing"""
+    for name, function in APP_HANDLERS:
+        handlers = getattr(bpy.app.handlers, name)
+        if function not in handlers:
+            handlers.append(function)
+
+def unregister_handlers():
+    for name, function in APP_HANDLERS:
+        handlers = getattr(bpy.app.handlers, name)
+        if function in handlers:
+            handlers.remove(function)
+
+    _background_pending.clear()
+    _selection.clear()
+    _proxy_pending.clear()
+
+    # the proxy worker thread would outlive a reload of the addon
+    proxy.shutdown()
+
 # ###############################
 #  Reconstruction Operators
 # ###############################
@@ -537,14 +820,7 @@ class CLIP_OT_calibrate_ibl(bpy.types.Operator):
     def poll(cls, context):
         if not context_clip(context): return False
 
-        movieclip = context.edit_movieclip
-        tracking = movieclip.tracking.objects [movieclip.tracking.active_object_index]
-
-        cls._selected_tracks = []
-        for track in tracking.tracks:
-            if track.select:
-                cls._selected_tracks.append(track)
-
+        cls._selected_tracks = selected_tracks(context.edit_movieclip, hidden=True)
         return len(cls._selected_tracks) == 4
 
     def execute(self, context):
@@ -576,6 +852,9 @@ class CLIP_OT_calibrate_ibl(bpy.types.Operator):
         nvecy = vecz.cross(vecx)
         nvecy.normalize()
 
+        # the 3d view will need an LDR proxy of the panorama, start it now
+        get_viewport_image_path(movieclip.filepath)
+
         # store orientation
         settings.orientation = sphere_to_euler(vecx, nvecy, vecz)
 
@@ -602,40 +881,49 @@ class CLIP_OT_draw_ibl_markers(bpy.types.Operator):
         return context.edit_movieclip
 
     def execute(self, context):
-
-        scene = context.scene
         movieclip = context.edit_movieclip
         settings = movieclip.ibl_settings
 
-        # convert panorama points to sphere points
-        verts = []
-        for vertex in (settings.vertex_0, settings.vertex_1, settings.vertex_2, settings.vertex_3):
-            verts.append(sphere_to_3d(vertex, settings.orientation, settings.camera_height))
+        draw_floor(context.scene, settings)
 
-        # make hull
-        pass
+        return {'FINISHED'}
 
-        # draw 3d mesh
-        edges = [(len(verts)-1, 0)]
-        for i in range(len(verts) -1 ):
-            edges.append((i,i+1))
+def draw_floor(scene, settings):
+    """
+    create or update the floor object with the calibration rectangle
+    the same mesh is reused, only its vertices move
+    """
+    # convert sphere points to 3d points
+    verts = panorama.sphere_to_3d( \
+            (settings.vertex_0, settings.vertex_1, settings.vertex_2, settings.vertex_3), \
+            settings.orientation, settings.camera_height)
 
-        mesh= bpy.data.meshes.new('IBL Floor')
+    object = bpy.data.objects.get("IBL Floor")
+    mesh = object.data if object and object.type == 'MESH' else None
 
-        mesh.from_pydata(verts, [], [range(len(verts))])
+    if mesh and len(mesh.vertices) == len(verts):
+        mesh.vertices.foreach_set('co', verts.astype(np.float32).ravel())
         mesh.update()
-        mesh.validate()
-        mesh.calc_normals()
+        return
 
-        object = bpy.data.objects.get("IBL Floor")
-        if not object:
-            object = bpy.data.objects.new("IBL Floor", mesh)
-            scene.objects.link(object)
-        else:
-            object.data = mesh
+    # draw 3d mesh
+    mesh= bpy.data.meshes.new('IBL Floor')
 
+    mesh.from_pydata(verts.tolist(), [], [range(len(verts))])
+    mesh.update()
+    mesh.validate()
+    mesh.calc_normals()
 
-        return {'FINISHED'}
+    if not object:
+        object = bpy.data.objects.new("IBL Floor", mesh)
+        scene.objects.link(object)
+    else:
+        old_mesh = object.data
+        object.data = mesh
+
+        # don't leave orphan meshes behind
+        if old_mesh and old_mesh.users == 0:
+            bpy.data.meshes.remove(old_mesh)
 
 class CLIP_OT_background_ibl(bpy.types.Operator):
     """creates a node in cycles with the orientation gathered from the calibration system"""
@@ -663,7 +951,10 @@ class CLIP_OT_background_ibl(bpy.types.Operator):
 
         # value to be used globally (e.g. edit operator)
         scene.orientation = settings.orientation
-        scene.ibl_image = get_image(movieclip.filepath).name
+        set_viewport_image(scene, movieclip.filepath)
+
+        # start the float proxy, so set sun doesn't decode the whole HDR
+        get_analysis_pixels(imagepath)
 
         if scene.render.engine == 'CYCLES':
             if not scene.world:
@@ -719,6 +1010,65 @@ class CLIP_OT_background_ibl(bpy.types.Operator):
 
         return {'FINISHED'}
 
+class CLIP_OT_set_sun(bpy.types.Operator):
+    """creates a sun lamp matching the brightest light of the HDR image"""
+    bl_idname = "clip.set_sun"
+    bl_label = "Set Sun"
+    bl_description = "Create a sun lamp with the direction, color, strength and size of the brightest light in the HDR"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return context_clip(context)
+
+    def execute(self, context):
+        scene = context.scene
+        movieclip = context.edit_movieclip
+        settings = movieclip.ibl_settings
+
+        imagepath = settings.hdr_file
+        if imagepath == '': imagepath = movieclip.filepath
+
+        # the cached float proxy if ready, decoding the HDR otherwise
+        source = get_analysis_pixels(imagepath)
+        if source is None: source = get_panorama(imagepath)
+        if source is None: source = panorama_pixels(imagepath)
+
+        if source is None:
+            self.report({'ERROR'}, "Panorama image not found")
+            return {'CANCELLED'}
+
+        try:
+            direction, color, irradiance, angle = sun.find_sun(source, settings.orientation)
+        finally:
+            if hasattr(source, 'close'): source.close()
+
+        lamp=bpy.data.lamps.get("IBL Sun")
+        if not lamp: lamp = bpy.data.lamps.new(name="IBL Sun", type='SUN')
+
+        lamp.type = 'SUN'
+        lamp.color = color
+        lamp.energy = irradiance
+
+        # cycles suns are disks at a distance of 1
+        lamp.shadow_soft_size = tan(angle * 0.5)
+
+        if lamp.node_tree:
+            emission = lamp.node_tree.nodes.get("Emission")
+            if emission: emission.inputs["Strength"].default_value = irradiance
+
+        object=bpy.data.objects.get("IBL Sun")
+        if not object:
+            object=bpy.data.objects.new(name="IBL Sun", object_data=lamp)
+            scene.objects.link(object)
+
+        # the sun shines along its -Z axis
+        object.data = lamp
+        object.rotation_euler = Vector(direction).to_track_quat('Z', 'Y').to_euler()
+        object.location = (0, 0, settings.camera_height)
+
+        return {'FINISHED'}
+
 # ###############################
 #  Interface
 # ###############################
@@ -753,6 +1103,7 @@ class IBLCalibrationPanel(IBLPanel, bpy.types.Panel):
         sub=col.column()
         sub.active= not settings.use_auto_background
         sub.operator("clip.background_ibl", text="Set IBL as Background")
+        col.operator("clip.set_sun", icon='LAMP_SUN')
 
         row = col.row(align=True)
         row.prop(settings, "hdr_file", text="")
@@ -0,0 +1,132 @@
+"""
+CPU reference of the 3D View panorama background.
+
+NumPy port of the edit.py fragment shaders, over a whole frame at once:
+every pixel is unprojected with the inverse projection * modelview
+matrix, looked up in the panorama, and replaces the foreground where
+nothing was drawn (or is blended with it for the wireframe modes).
+The math follows the GLSL code line by line, so it can be used to make
+preview plates without a GPU and to check and benchmark the shaders.
+
+All the images are (height, width, channels) arrays, top row first.
+"""
+
+import numpy as np
+
+from . import panorama
+
+# depth buffer value above which the pixel shows the background
+DEPTH_BACKGROUND = 0.99995
+
+# ###############################
+#  Shader Math
+# ###############################
+
+def view_matrix(projection, modelview, orientation=(0.0, 0.0, 0.0), location=(0.0, 0.0, 0.0)):
+    """
+    projectionmodelviewinverse uniform of the shader, as built by draw_callback_px
+    projection, modelview : 4x4 matrices of the view (row major, as mathutils)
+    orientation : calibration euler, applied to the modelview
+    location : camera location, the modelview is translated to it first (glTranslatef)
+    """
+    translation = np.identity(4)
+    translation[:3, 3] = location
+
+    rotation = np.identity(4)
+    rotation[:3, :3] = panorama.euler_to_matrix(orientation)
+
+    modelview = np.dot(np.asarray(modelview, dtype=np.float64), np.dot(translation, rotation))
+    matrix = np.dot(np.asarray(projection, dtype=np.float64), modelview)
+    return np.linalg.inv(matrix)
+
+def unproject(width, height, matrix):
+    """
+    glUnprojectGL() of the center of every pixel
+    returns a (height, width, 3) array of (not normalized) world vectors
+    """
+    s = (np.arange(width) + 0.5) / width
+    t = (np.arange(height)[::-1] + 0.5) / height
+
+    view = np.empty((height, width, 4))
+    view[:, :, 0] = (s * 2.0 - 1.0)[None, :]
+    view[:, :, 1] = (t * 2.0 - 1.0)[:, None]
+    view[:, :, 2] = -1.0
+    view[:, :, 3] = 1.0
+
+    world = view.dot(np.asarray(matrix, dtype=np.float64).T)
+
+    # the shader multiplies by w
+    return world[:, :, :3] * world[:, :, 3:]
+
+def equirectangular(verts):
+    """
+    equirectangular() of (N,3) unit vectors
+    same as panorama.sphere_to_equirectangular, with u shifted by a whole turn
+    """
+    verts = np.asarray(verts, dtype=np.float64).reshape(-1, 3)
+
+    theta = np.arcsin(np.clip(verts[:, 2], -1.0, 1.0))
+    phi = np.arctan2(verts[:, 0], verts[:, 1])
+
+    uv = np.empty((len(verts), 2))
+    uv[:, 0] = 0.5 * (phi / np.pi) + 0.25
+    uv[:, 1] = 0.5 + theta / np.pi
+
+    return uv
+
+def sample_nearest(texture, uv):
+    """
+    texture2D() of (N,2) uv with GL_NEAREST filter and GL_REPEAT wrap
+    returns a (N, channels) array
+    """
+    height, width = texture.shape[:2]
+
+    x = np.floor(uv[:, 0] * width).astype(np.int64) % width
+    y = np.floor(uv[:, 1] * height).astype(np.int64) % height
+
+    # v goes up, the rows are stored from the top
+    return texture[height - 1 - y, x]
+
+def _rgba(pixels):
+    """RGB images read as RGBA, with an opaque alpha"""
+    pixels = np.asarray(pixels, dtype=np.float32)
+    if pixels.shape[-1] == 4:
+        return pixels
+
+    rgba = np.ones(pixels.shape[:-1] + (4,), dtype=np.float32)
+    rgba[..., :3] = pixels[..., :3]
+    return rgba
+
+def background(width, height, matrix, texture):
+    """(height, width, 4) panorama seen through the matrix"""
+    world = panorama.normalize(unproject(width, height, matrix).reshape(-1, 3))
+    return sample_nearest(_rgba(texture), equirectangular(world)).reshape(height, width, 4)
+
+# ###############################
+#  Composite
+# ###############################
+
+def composite(color, depth, matrix, texture, threshold=DEPTH_BACKGROUND):
+    """
+    fragment_shader: the panorama where nothing was drawn
+    color : (height, width, 3|4) frame
+    depth : (height, width) depth buffer, from 0.0 to 1.0
+    matrix : projectionmodelviewinverse, see view_matrix
+    texture : panorama
+    returns a (height, width, 4) float32 array
+    """
+    foreground = _rgba(color)
+    height, width = foreground.shape[:2]
+
+    empty = np.asarray(depth).reshape(height, width) > threshold
+    return np.where(empty[:, :, None], background(width, height, matrix, texture), foreground)
+
+def composite_wire(color, matrix, texture, alpha=0.5):
+    """
+    fragment_shader_wire: the panorama blended over the frame
+    returns a (height, width, 4) float32 array
+    """
+    foreground = _rgba(color)
+    height, width = foreground.shape[:2]
+
+    return foreground * (1.0 - alpha) + background(width, height, matrix, texture) * alpha
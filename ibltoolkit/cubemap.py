@@ -0,0 +1,188 @@
+"""
+Equirectangular panorama to cubemap conversion, and back.
+
+The faces are a (6, size, size, channels) array in the FACES order,
+every face stored top row first. Seen from the center the side faces
+have +Z up, the top face has +X at its bottom edge and the bottom face
+has +X at its top edge.
+
+The images are numpy (or memory-mapped) arrays stored top row first.
+They are resampled in tiles on a thread pool, numpy releases the GIL
+for the heavy lifting.
+"""
+
+import numpy as np
+
+from . import panorama
+from . import tiles
+
+FACES = ('px', 'nx', 'py', 'ny', 'pz', 'nz')
+
+# forward and up vectors of the faces, right is forward x up
+FACE_AXES = (
+    ((1.0, 0.0, 0.0), (0.0, 0.0, 1.0)),
+    ((-1.0, 0.0, 0.0), (0.0, 0.0, 1.0)),
+    ((0.0, 1.0, 0.0), (0.0, 0.0, 1.0)),
+    ((0.0, -1.0, 0.0), (0.0, 0.0, 1.0)),
+    ((0.0, 0.0, 1.0), (-1.0, 0.0, 0.0)),
+    ((0.0, 0.0, -1.0), (1.0, 0.0, 0.0)),
+    )
+
+FILTERS = ('BILINEAR', 'AREA')
+
+# rows resampled by each job
+TILE_HEIGHT = 32
+
+# ###############################
+#  Face Geometry
+# ###############################
+
+def face_basis():
+    """(6,3,3) forward, right and up vectors of every face"""
+    basis = np.empty((6, 3, 3))
+    for face, (forward, up) in enumerate(FACE_AXES):
+        basis[face] = forward, np.cross(forward, up), up
+    return basis
+
+def face_directions(face, size, rows, samples=1):
+    """
+    (not normalized) directions of the pixels of a face
+    rows : (start, end) face rows, from the top
+    samples : sub pixels per axis, on a regular grid
+    returns a ((end - start) * samples, size * samples, 3) array
+    """
+    start, end = rows
+    forward, right, up = face_basis()[face]
+
+    offsets = (np.arange(samples) + 0.5) / samples
+    s = (np.arange(size)[:, None] + offsets).ravel() * (2.0 / size) - 1.0
+    t = 1.0 - (np.arange(start, end)[:, None] + offsets).ravel() * (2.0 / size)
+
+    return forward + s[None, :, None] * right + t[:, None, None] * up
+
+def direction_to_face(directions):
+    """
+    face of (N,3) directions, and where they hit it
+    returns the face index and the x, y coordinates, 0,0 (top left) 1,1 (bottom right)
+    """
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+
+    axis = np.argmax(np.abs(directions), axis=1)
+    negative = directions[np.arange(len(directions)), axis] < 0.0
+    face = axis * 2 + negative
+
+    basis = face_basis()[face]
+    depth = np.einsum('ij,ij->i', directions, basis[:, 0])
+    s = np.einsum('ij,ij->i', directions, basis[:, 1]) / depth
+    t = np.einsum('ij,ij->i', directions, basis[:, 2]) / depth
+
+    return face, (s + 1.0) * 0.5, (1.0 - t) * 0.5
+
+# ###############################
+#  Sampling
+# ###############################
+
+def sample_cubemap(faces, directions):
+    """
+    bilinear lookup of (N,3) directions in the faces, clamped at the face edges
+    returns a (N, channels) float32 array
+    """
+    size = faces.shape[1]
+    face, x, y = direction_to_face(directions)
+
+    x = x * size - 0.5
+    y = y * size - 0.5
+
+    x0 = np.floor(x)
+    y0 = np.floor(y)
+    fx = (x - x0).astype(np.float32)[:, None]
+    fy = (y - y0).astype(np.float32)[:, None]
+
+    x1 = np.clip(x0.astype(np.int64) + 1, 0, size - 1)
+    y1 = np.clip(y0.astype(np.int64) + 1, 0, size - 1)
+    x0 = np.clip(x0.astype(np.int64), 0, size - 1)
+    y0 = np.clip(y0.astype(np.int64), 0, size - 1)
+
+    top = faces[face, y0, x0] * (1.0 - fx) + faces[face, y0, x1] * fx
+    bottom = faces[face, y1, x0] * (1.0 - fx) + faces[face, y1, x1] * fx
+
+    return (top * (1.0 - fy) + bottom * fy).astype(np.float32, copy=False)
+
+def filter_samples(filter, source_width, target_width):
+    """
+    sub pixels per axis for the filter
+    the area filter takes about one sample per source pixel when downsampling
+    """
+    if filter not in FILTERS:
+        raise ValueError("unknown filter {}".format(filter))
+
+    if filter == 'BILINEAR':
+        return 1
+
+    return max(1, int(np.ceil(source_width / target_width)))
+
+def _box(pixels, height, width, samples):
+    """average the sub pixels of a (height * samples, width * samples, channels) tile"""
+    pixels = pixels.reshape(height, samples, width, samples, -1)
+    return pixels.mean(axis=(1, 3))
+
+# ###############################
+#  Conversion
+# ###############################
+
+def equirectangular_to_cubemap(image, size, filter='AREA', threads=None):
+    """
+    resample a (height, width, channels) panorama to six size x size faces
+    returns a (6, size, size, channels) float32 array
+    """
+    image = np.asarray(image)
+    if image.ndim == 2:
+        image = image[:, :, None]
+
+    # the equator is 4 faces wide
+    samples = filter_samples(filter, image.shape[1], 4 * size)
+    faces = np.empty((6, size, size, image.shape[2]), dtype=np.float32)
+
+    def tile(face, start, end):
+        directions = face_directions(face, size, (start, end), samples).reshape(-1, 3)
+        uv = panorama.sphere_to_equirectangular(panorama.normalize(directions))
+        pixels = panorama.sample_bilinear(image, uv)
+        faces[face, start:end] = _box(pixels, end - start, size, samples)
+
+    jobs = [(face, start, min(start + TILE_HEIGHT, size)) \
+            for face in range(6) for start in range(0, size, TILE_HEIGHT)]
+    tiles.run_threaded(tile, jobs, threads)
+
+    return faces
+
+def cubemap_to_equirectangular(faces, width, height=None, filter='AREA', threads=None):
+    """
+    resample (6, size, size, channels) faces to a width x height panorama
+    returns a (height, width, channels) float32 array, top row first
+    """
+    faces = np.asarray(faces)
+    if faces.ndim == 3:
+        faces = faces[:, :, :, None]
+
+    height = height or width // 2
+    samples = filter_samples(filter, 4 * faces.shape[1], width)
+    image = np.empty((height, width, faces.shape[3]), dtype=np.float32)
+
+    offsets = (np.arange(samples) + 0.5) / samples
+    u = (np.arange(width)[:, None] + offsets).ravel() / width
+
+    def tile(start, end):
+        v = 1.0 - (np.arange(start, end)[:, None] + offsets).ravel() / height
+
+        uv = np.empty((len(v), len(u), 2))
+        uv[:, :, 0] = u[None, :]
+        uv[:, :, 1] = v[:, None]
+
+        directions = panorama.equirectangular_to_sphere(uv.reshape(-1, 2))
+        pixels = sample_cubemap(faces, directions)
+        image[start:end] = _box(pixels, end - start, width, samples)
+
+    jobs = [(start, min(start + TILE_HEIGHT, height)) for start in range(0, height, TILE_HEIGHT)]
+    tiles.run_threaded(tile, jobs, threads)
+
+    return image
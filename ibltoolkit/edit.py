@@ -1,10 +1,18 @@
 # - get camera  internal offset
 # - calculate camera vector
 
+import hashlib
+import json
+import time
+from collections import deque
+
 import bpy
+from bpy.props import StringProperty
+from bpy_extras.io_utils import ExportHelper
 from bgl import *
 from mathutils import Matrix, Euler
 
+# composite.py has a NumPy reference of these shaders, keep them in sync
 fragment_shader ="""
 #version 120
 uniform sampler2D color_buffer;
@@ -12,6 +20,7 @@ uniform sampler2D depth_buffer;
 uniform sampler2D texture_buffer;
 
 uniform mat4 projectionmodelviewinverse;
+uniform vec2 buffer_scale;
 
 #define PI  3.14159265
 
@@ -40,11 +49,11 @@ vec2 equirectangular(vec3 vert)
 void main(void)
 {
     vec2 coords = gl_TexCoord[0].st;
-    vec4 foreground = texture2D(color_buffer, coords);
+    vec4 foreground = texture2D(color_buffer, coords * buffer_scale);
     vec3 world = glUnprojectGL(coords);
     vec4 background = texture2D(texture_buffer, equirectangular(normalize(world)));
 
-    float depth = texture2D(depth_buffer, coords).s;
+    float depth = texture2D(depth_buffer, coords * buffer_scale).s;
 
     if (depth > 0.99995){
         foreground = background;
@@ -59,6 +68,7 @@ fragment_shader_wire ="""
 uniform sampler2D color_buffer;
 uniform sampler2D texture_buffer;
 uniform mat4 projectionmodelviewinverse;
+uniform vec2 buffer_scale;
 uniform float alpha;
 
 #define PI  3.14159265
@@ -88,7 +98,7 @@ vec2 equirectangular(vec3 vert)
 void main(void)
 {
     vec2 coords = gl_TexCoord[0].st;
-    vec4 foreground = texture2D(color_buffer, coords);
+    vec4 foreground = texture2D(color_buffer, coords * buffer_scale);
     vec3 world = glUnprojectGL(coords);
     vec4 background = texture2D(texture_buffer, equirectangular(normalize(world)));
 
@@ -147,19 +157,10 @@ def print_program_errors(program):
 # OpenGL Image Routines
 # ######################
 
-def resize(self, context):
-    """we can run every frame or only when width/height change"""
-    # remove old textures
-    self.quit()
-
-    self.width = context.region.width
-    self.height = context.region.height
-
-    self.buffer_width, self.buffer_height = calculate_image_size(self.width, self.height)
-
-    # image to dump screen
-    self.color_id = create_image(self.buffer_width, self.buffer_height, GL_RGBA)
-    self.depth_id = create_image(self.buffer_width, self.buffer_height, GL_DEPTH_COMPONENT32)
+def resize(self, width, height):
+    """make sure the screen textures fit the region, they only change when it outgrows them"""
+    self.color_texture = fit_texture(self.color_texture, GL_RGBA, width, height)
+    self.depth_texture = fit_texture(self.depth_texture, GL_DEPTH_COMPONENT32, width, height)
 
 def calculate_image_size(width, height):
     """get a power of 2 size"""
@@ -175,29 +176,23 @@ def calculate_image_size(width, height):
 
     return buffer_width, buffer_height
 
-def update_image(tex_id, viewport, target=GL_RGBA, texture=GL_TEXTURE0):
-    """copy the current buffer to the image"""
+def update_image(tex_id, viewport, texture=GL_TEXTURE0):
+    """copy the current buffer to the bottom left of the image, its storage is kept"""
     glActiveTexture(texture)
     glBindTexture(GL_TEXTURE_2D, tex_id)
-    glCopyTexImage2D(GL_TEXTURE_2D, 0, target, viewport[0], viewport[1], viewport[2], viewport[3], 0)
-
+    glCopyTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, viewport[0], viewport[1], viewport[2], viewport[3])
 
 def create_image(width, height, target=GL_RGBA):
-    """create an empty image, dimensions pow2"""
-    if target == GL_RGBA:
-        target, internal_format, dimension  = GL_RGBA, GL_RGB, 3
-    else:
-        target, internal_format, dimension = GL_DEPTH_COMPONENT32, GL_DEPTH_COMPONENT, 1
-
-    null_buffer = Buffer(GL_BYTE, [(width + 1) * (height + 1) * dimension])
-
+    """
+    create an image, dimensions pow2
+    OpenGL allocates it from the screen, no client side buffer needed
+    """
     id_buf = Buffer(GL_INT, 1)
     glGenTextures(1, id_buf)
 
     tex_id = id_buf.to_list()[0]
     glBindTexture(GL_TEXTURE_2D, tex_id)
 
-    glTexImage2D(GL_TEXTURE_2D, 0, target, width, height, 0, internal_format, GL_UNSIGNED_BYTE, null_buffer)
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
 
@@ -208,18 +203,69 @@ def create_image(width, height, target=GL_RGBA):
 
     glBindTexture(GL_TEXTURE_2D, 0)
 
-    del null_buffer
-
     return tex_id
 
 def delete_image(tex_id):
     """clear created image"""
     id_buf = Buffer(GL_INT, 1)
-    id_buf.to_list()[0] = tex_id
+    id_buf[0] = tex_id
 
     if glIsTexture(tex_id):
         glDeleteTextures(1, id_buf)
 
+# ######################
+# Screen Texture Pool
+# ######################
+
+# free screen textures kept for reuse, at most POOL_SIZE
+POOL_SIZE = 4
+_pool = []
+
+class ScreenTexture:
+    """texture the screen buffers are copied to, bigger than the region"""
+    def __init__(self, target, width, height):
+        # power of two dimensions, they leave room to grow as well
+        self.width, self.height = calculate_image_size(width, height)
+        self.target = target
+        self.id = create_image(self.width, self.height, target)
+
+    def fits(self, target, width, height):
+        return self.target == target and self.width >= width and self.height >= height
+
+def acquire_texture(target, width, height):
+    """screen texture of at least width x height, from the pool if one fits"""
+    textures = [texture for texture in _pool if texture.fits(target, width, height)]
+
+    if not textures:
+        return ScreenTexture(target, width, height)
+
+    # the smallest one that fits
+    texture = min(textures, key=lambda texture: texture.width * texture.height)
+    _pool.remove(texture)
+    return texture
+
+def release_texture(texture):
+    """give the texture back to the pool, the oldest ones are deleted"""
+    _pool.append(texture)
+
+    while len(_pool) > POOL_SIZE:
+        delete_image(_pool.pop(0).id)
+
+def fit_texture(texture, target, width, height):
+    """the texture if it still fits, otherwise a bigger one"""
+    if texture and texture.fits(target, width, height):
+        return texture
+
+    if texture:
+        release_texture(texture)
+
+    return acquire_texture(target, width, height)
+
+def free_textures():
+    """delete the pooled textures"""
+    while _pool:
+        delete_image(_pool.pop().id)
+
 # ##################
 # GLSL Screen Shader
 # ##################
@@ -241,29 +287,37 @@ def create_shader(source, program=None, type=GL_FRAGMENT_SHADER):
     glAttachShader(program, shader)
     glLinkProgram(program)
 
+    # the program keeps it, it goes away with it
+    glDeleteShader(shader)
+
     return program
 
-def setup_uniforms(program, color_id, depth_id, texture_id, projectionmodelviewinverse, alpha):
+def setup_uniforms(program, color_id, depth_id, texture_id, projectionmodelviewinverse, buffer_scale, alpha):
+    """program is a ScreenProgram, its uniform locations are resolved at link time"""
+    uniforms = program.uniforms
 
-    uniform = glGetUniformLocation(program, "color_buffer")
+    uniform = uniforms["color_buffer"]
     glActiveTexture(GL_TEXTURE0)
     glBindTexture(GL_TEXTURE_2D, color_id)
     if uniform != -1: glUniform1i(uniform, 0)
 
-    uniform = glGetUniformLocation(program, "depth_buffer")
+    uniform = uniforms["depth_buffer"]
     glActiveTexture(GL_TEXTURE1)
     glBindTexture(GL_TEXTURE_2D, depth_id)
     if uniform != -1: glUniform1i(uniform, 1)
 
-    uniform = glGetUniformLocation(program, "texture_buffer")
+    uniform = uniforms["texture_buffer"]
     glActiveTexture(GL_TEXTURE2)
     glBindTexture(GL_TEXTURE_2D, texture_id)
     if uniform != -1: glUniform1i(uniform, 2)
 
-    uniform = glGetUniformLocation(program, "projectionmodelviewinverse")
+    uniform = uniforms["projectionmodelviewinverse"]
     if uniform != -1: glUniformMatrix4fv(uniform, 1, 0, projectionmodelviewinverse)
 
-    uniform = glGetUniformLocation(program, "alpha")
+    uniform = uniforms["buffer_scale"]
+    if uniform != -1: glUniform2f(uniform, buffer_scale[0], buffer_scale[1])
+
+    uniform = uniforms["alpha"]
     if uniform != -1: glUniform1f(uniform, alpha)
 
 def bindcode(image):
@@ -271,6 +325,128 @@ def bindcode(image):
     image.gl_touch(GL_NEAREST)
     return image.bindcode
 
+# ##################
+# GLSL Program Cache
+# ##################
+
+# uniforms of the screen shaders
+UNIFORMS = ("color_buffer", "depth_buffer", "texture_buffer", "projectionmodelviewinverse", "buffer_scale", "alpha")
+
+# linked programs shared by all the operators and 3d views, by source hash
+_programs = {}
+
+class ScreenProgram:
+    """linked screen shader program, with its uniform locations"""
+    def __init__(self, source, key):
+        self.key = key
+        self.program = create_shader(source)
+        self.uniforms = {name: glGetUniformLocation(self.program, name) for name in UNIFORMS}
+        self.users = 0
+
+def acquire_program(source):
+    """shared program of the shader source, compiled and linked only once"""
+    key = hashlib.sha1(source.encode()).hexdigest()
+
+    program = _programs.get(key)
+    if not program:
+        program = _programs[key] = ScreenProgram(source, key)
+
+    program.users += 1
+    return program
+
+def release_program(program):
+    """the program is deleted when its last user releases it"""
+    program.users -= 1
+
+    # free_gl may have deleted it already
+    if program.users <= 0 and _programs.get(program.key) is program:
+        del _programs[program.key]
+        glDeleteProgram(program.program)
+
+def free_gl():
+    """delete the pooled textures and the cached programs, when the addon is unregistered"""
+    free_textures()
+
+    for program in _programs.values():
+        glDeleteProgram(program.program)
+    _programs.clear()
+
+# ##################
+# Frame Timings
+# ##################
+
+# stages of draw_callback_px, timed on the cpu: the gl calls are only queued,
+# unless the timings are synced (glFinish before every mark)
+STAGES = ("copy color", "copy depth", "matrices", "bind textures", "draw")
+
+# frames kept for the rolling statistics
+TIMINGS_SIZE = 256
+
+# seconds between the timings panel refreshes
+TIMINGS_REFRESH = 0.5
+
+# perf_counter is Python 3.3+
+clock = getattr(time, 'perf_counter', time.time)
+
+class FrameTimings:
+    """ring buffer with the stage durations of the last drawn frames"""
+    def __init__(self, size=TIMINGS_SIZE):
+        self.samples = deque(maxlen=size)
+        self.frames = 0
+        self.refreshed = 0.0
+        self.synced = False
+
+    def record(self, marks, synced=False):
+        """
+        marks : clock() before the first stage and after every stage
+        synced : if the gl calls were finished before every mark,
+        the samples of the other mode are dropped when it changes
+        """
+        if synced != self.synced:
+            self.reset()
+            self.synced = synced
+
+        self.samples.append(tuple(end - start for start, end in zip(marks, marks[1:])))
+        self.frames += 1
+
+    def reset(self):
+        self.samples.clear()
+        self.frames = 0
+
+    def summary(self):
+        """[(stage, average, p95)] in milliseconds, the total last"""
+        if not self.samples: return []
+
+        columns = list(zip(*self.samples))
+        columns.append([sum(frame) for frame in self.samples])
+
+        summary = []
+        for stage, durations in zip(STAGES + ("total",), columns):
+            durations = sorted(durations)
+            p95 = durations[min(len(durations) - 1, int(0.95 * len(durations)))]
+            summary.append((stage, 1000.0 * sum(durations) / len(durations), 1000.0 * p95))
+
+        return summary
+
+    def to_json(self):
+        return json.dumps({
+            "frames": self.frames,
+            "window": len(self.samples),
+            "synced": self.synced,
+            "stages": STAGES,
+            "summary": {stage: {"average_ms": average, "p95_ms": p95} \
+                    for stage, average, p95 in self.summary()},
+            "samples_ms": [[1000.0 * duration for duration in frame] for frame in self.samples],
+            }, indent=2)
+
+# shared by all the 3d views
+timings = FrameTimings()
+
+def timing_mark(sync):
+    """clock(), once the queued gl calls are done if sync"""
+    if sync: glFinish()
+    return clock()
+
 # ##################
 # Drawing Routines
 # ##################
@@ -318,18 +494,44 @@ def draw_rectangle(zed=0.0):
 
 def draw_callback_px(self, context):
     """core function"""
-    if not self._enabled: return
+    # the state is checked every frame, so changes apply right away
+    # bug, waiting for fix: "[#31026] context.region broken after QuadView on + off"
+    space = context.space_data
+    if not space or space.type != 'VIEW_3D': return
+
+    viewport_shade = space.viewport_shade
+    if viewport_shade == 'RENDERED': return
+
+    # the HDR is swapped for its proxy once it is generated
+    image = bpy.data.images.get(context.scene.ibl_image)
+    if image: self.image = image
+
+    # wireframe mode has no DEPTH
+    if viewport_shade in ('WIREFRAME', 'BOUNDBOX'):
+        self.program = self.program_wire
+    else:
+        self.program = self.program_shader
+
+    wm = context.window_manager
+    sync = wm.ibl_timings and wm.ibl_timings_sync
+    marks = [timing_mark(sync)]
 
     act_tex = Buffer(GL_INT, 1)
     glGetIntegerv(GL_ACTIVE_TEXTURE, act_tex)
 
     glGetIntegerv(GL_VIEWPORT, self.viewport)
 
+    # the region may have outgrown the textures since the last frame
+    if not self.color_texture.fits(GL_RGBA, self.viewport[2], self.viewport[3]):
+        resize(self, self.viewport[2], self.viewport[3])
+
     # (1) dump buffer in texture
-    update_image(self.color_id, self.viewport, GL_RGBA, GL_TEXTURE0)
+    update_image(self.color_texture.id, self.viewport, GL_TEXTURE0)
+    marks.append(timing_mark(sync))
 
     # (2) dump zed buffer in texture
-    update_image(self.depth_id, self.viewport, GL_DEPTH_COMPONENT, GL_TEXTURE1)
+    update_image(self.depth_texture.id, self.viewport, GL_TEXTURE1)
+    marks.append(timing_mark(sync))
 
     # (3) run screenshader
     glEnable(GL_DEPTH_TEST)
@@ -358,8 +560,15 @@ def draw_callback_px(self, context):
     modelviewprojinv_matrix = (projection_matrix * modelview_matrix).inverted()
     modelviewprojinv_mat = Buffer(GL_FLOAT, (4,4), modelviewprojinv_matrix.transposed())
 
-    glUseProgram(self.program)
-    setup_uniforms(self.program, self.color_id, self.depth_id, bindcode(self.image), modelviewprojinv_mat, self.alpha)
+    # the screen only fills the bottom left of the textures
+    buffer_scale = (self.viewport[2] / self.color_texture.width, self.viewport[3] / self.color_texture.height)
+    marks.append(timing_mark(sync))
+
+    glUseProgram(self.program.program)
+    setup_uniforms(self.program, self.color_texture.id, self.depth_texture.id, bindcode(self.image), \
+            modelviewprojinv_mat, buffer_scale, self.alpha)
+    marks.append(timing_mark(sync))
+
     draw_rectangle()
 
     # (4) restore opengl defaults
@@ -370,6 +579,17 @@ def draw_callback_px(self, context):
 
     glMatrixMode(GL_MODELVIEW)
     glTranslatef(-cam_pos[0], -cam_pos[1], -cam_pos[2])
+    marks.append(timing_mark(sync))
+
+    if wm.ibl_timings:
+        timings.record(marks, sync)
+
+        # the panel only redraws on events, refresh it while the timings run
+        if marks[-1] - timings.refreshed > TIMINGS_REFRESH:
+            timings.refreshed = marks[-1]
+
+            for region in context.area.regions:
+                if region.type == 'UI': region.tag_redraw()
 
 class VIEW_IBL_3DViewOperator(bpy.types.Operator):
     """"""
@@ -377,40 +597,14 @@ class VIEW_IBL_3DViewOperator(bpy.types.Operator):
     bl_label = "IBL in 3d View"
     bl_description = "Shows the panorama as background for the 3dview"
 
-    _enabled = True
-    _timer = None
-
     def modal(self, context, event):
         if event.type == 'ESC':
             return self.cancel(context)
 
-        if event.type == 'TIMER':
-
-            # bug, waiting for fix: "[#31026] context.region broken after QuadView on + off"
-            # http://projects.blender.org/tracker/index.php?func=detail&aid=31026&group_id=9&atid=498
-            if not context.region or \
-                not context.space_data or \
-                context.space_data.type != 'VIEW_3D':
-                return {'PASS_THROUGH'}
-
-            viewport_shade = context.space_data.viewport_shade
-            self._enabled = (viewport_shade != 'RENDERED')
-
-            if viewport_shade in ('WIREFRAME', 'BOUNDBOX'):
-                self.program= self.program_wire
-            else:
-                self.program = self.program_shader
-
-            if (self.width != context.region.width) or (self.height != context.region.height):
-                resize(self, context)
-
+        # shading and region size are handled by the draw callback
         return {'PASS_THROUGH'}
 
     def execute(self, context):
-        context.window_manager.modal_handler_add(self)
-        self._timer = context.window_manager.event_timer_add(0.1, context.window)
-        self._handle = context.region.callback_add(draw_callback_px, (self, context), 'POST_VIEW')
-
         scene = context.scene
         # getting the image saved from the calibration operator
         image = bpy.data.images.get(scene.ibl_image)
@@ -423,41 +617,44 @@ class VIEW_IBL_3DViewOperator(bpy.types.Operator):
         self.image = image
 
         self.viewport = Buffer(GL_INT, 4)
-        self.width = context.region.width
-        self.height = context.region.height
-
-        # power of two dimensions
-        self.buffer_width, self.buffer_height = calculate_image_size(self.width, self.height)
 
         # images to dump the screen buffers
-        self.color_id = create_image(self.buffer_width, self.buffer_height, GL_RGBA)
-        self.depth_id = create_image(self.buffer_width, self.buffer_height, GL_DEPTH_COMPONENT32)
+        self.color_texture = None
+        self.depth_texture = None
+        resize(self, context.region.width, context.region.height)
 
-        # glsl shaders
-        # wireframe mode has no DEPTH
-        self.program_shader = create_shader(fragment_shader)
-        self.program_wire = create_shader(fragment_shader_wire)
+        # glsl shaders, shared with the other 3d views
+        self.program_shader = acquire_program(fragment_shader)
+        self.program_wire = acquire_program(fragment_shader_wire)
         self.program = self.program_shader
 
         self.orientation = scene.orientation.to_matrix().to_4x4()
 
         self.alpha = 0.5
 
+        # only drawn once everything is set
+        context.window_manager.modal_handler_add(self)
+        self._handle = context.region.callback_add(draw_callback_px, (self, context), 'POST_VIEW')
+
         return {'RUNNING_MODAL'}
 
     def cancel(self, context):
-        context.window_manager.event_timer_remove(self._timer)
         context.region.callback_remove(self._handle)
         self.quit()
+
+        release_program(self.program_shader)
+        release_program(self.program_wire)
         return {'CANCELLED'}
 
     def quit(self):
-        """garbage colect"""
-        if self.color_id:
-            delete_image(self.color_id)
+        """garbage colect, the textures go back to the pool"""
+        if self.color_texture:
+            release_texture(self.color_texture)
+            self.color_texture = None
 
-        if self.depth_id:
-            delete_image(self.depth_id)
+        if self.depth_texture:
+            release_texture(self.depth_texture)
+            self.depth_texture = None
 
 class VIEW3D_PT_IBL_background(bpy.types.Panel):
     bl_space_type = 'VIEW_3D'
@@ -475,6 +672,53 @@ class VIEW3D_PT_IBL_background(bpy.types.Panel):
         view = context.space_data
         self.layout.operator("wm.ibl_edit_background")
 
+        wm = context.window_manager
+        layout.prop(wm, "ibl_timings")
+
+        if not wm.ibl_timings:
+            return
+
+        layout.prop(wm, "ibl_timings_sync")
+
+        col = layout.column(align=True)
+        col.label(text="{} frames, last {}".format(timings.frames, len(timings.samples)))
+        col.label(text="Synced (glFinish)" if timings.synced else "Not synced, GPU time not included")
+
+        for stage, average, p95 in timings.summary():
+            col.label(text="{}: {:.3f} ms (p95 {:.3f})".format(stage.capitalize(), average, p95))
+
+        row = layout.row(align=True)
+        row.operator("wm.ibl_timings_dump")
+        row.operator("wm.ibl_timings_reset")
+
+class VIEW_IBL_TimingsDumpOperator(bpy.types.Operator, ExportHelper):
+    """"""
+    bl_idname = "wm.ibl_timings_dump"
+    bl_label = "Dump Timings"
+    bl_description = "Save the panorama background frame timings as JSON"
+
+    filename_ext = ".json"
+    filter_glob = StringProperty(default="*.json", options={'HIDDEN'})
+
+    def execute(self, context):
+        filepath = bpy.path.abspath(bpy.path.ensure_ext(self.filepath, self.filename_ext))
+
+        with open(filepath, 'w') as f:
+            f.write(timings.to_json())
+
+        self.report({'INFO'}, "Timings of {} frames saved in {}".format(len(timings.samples), filepath))
+        return {'FINISHED'}
+
+class VIEW_IBL_TimingsResetOperator(bpy.types.Operator):
+    """"""
+    bl_idname = "wm.ibl_timings_reset"
+    bl_label = "Reset"
+    bl_description = "Clear the panorama background frame timings"
+
+    def execute(self, context):
+        timings.reset()
+        return {'FINISHED'}
+
 # ###############################
 #  Main / Register / Unregister
 # ###############################
@@ -483,6 +727,7 @@ def register():
     bpy.utils.register_module(__name__)
 
 def unregister():
+    free_gl()
     bpy.utils.unregister_module(__name__)
 
 if __name__ == '__main__':
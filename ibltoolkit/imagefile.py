@@ -0,0 +1,645 @@
+"""
+Streaming image files for panorama sized outputs.
+
+The writers take the image a few rows at a time, from the top row down,
+and write them to disk as they come, so the full frame never needs to
+be in memory. The readers memory-map the file and only decode the rows
+that are requested. Pure numpy, no bpy.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+# ###############################
+#  OpenEXR
+# ###############################
+
+EXR_MAGIC = 20000630
+EXR_UINT = 0
+EXR_HALF = 1
+EXR_FLOAT = 2
+EXR_NO_COMPRESSION = 0
+EXR_ZIPS_COMPRESSION = 2
+EXR_ZIP_COMPRESSION = 3
+EXR_TILED = 0x200
+
+# scanlines per ZIP compressed chunk
+EXR_ZIP_LINES = 16
+
+def _exr_attribute(name, type, value):
+    return name.encode() + b'\0' + type.encode() + b'\0' + struct.pack('<i', len(value)) + value
+
+def _exr_zip(raw):
+    """interleave and delta encode the bytes (ImfZip), then deflate"""
+    raw = np.frombuffer(raw, dtype=np.uint8)
+    data = np.concatenate((raw[0::2], raw[1::2]))
+    data[1:] = np.diff(data) + 128
+    return zlib.compress(data.tobytes())
+
+def _exr_unzip(data, size):
+    """inverse of _exr_zip"""
+    data = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+    if len(data) != size:
+        raise ValueError("Corrupted EXR chunk")
+
+    # undo the delta encoding, in modulo 256
+    data = np.cumsum(data - np.uint8(128), dtype=np.uint8) + np.uint8(128)
+
+    raw = np.empty(size, dtype=np.uint8)
+    half = (size + 1) // 2
+    raw[0::2] = data[:half]
+    raw[1::2] = data[half:]
+    return raw.tobytes()
+
+class EXRWriter:
+    """
+    scanline OpenEXR writer, ZIP compressed half float
+
+    rows are written with write() as (N, width, channels) float arrays,
+    top row first, in the same order as the channel names
+    """
+    def __init__(self, filepath, width, height, channels=('R', 'G', 'B', 'A')):
+        self.width = width
+        self.height = height
+
+        # the file stores the channels sorted by name
+        self._order = sorted(range(len(channels)), key=lambda i: channels[i])
+
+        chlist = b''
+        for i in self._order:
+            chlist += channels[i].encode() + b'\0' + struct.pack('<iB3xii', EXR_HALF, 0, 1, 1)
+        chlist += b'\0'
+
+        window = struct.pack('<iiii', 0, 0, width - 1, height - 1)
+
+        header = struct.pack('<ii', EXR_MAGIC, 2)
+        header += _exr_attribute('channels', 'chlist', chlist)
+        header += _exr_attribute('compression', 'compression', struct.pack('<B', EXR_ZIP_COMPRESSION))
+        header += _exr_attribute('dataWindow', 'box2i', window)
+        header += _exr_attribute('displayWindow', 'box2i', window)
+        header += _exr_attribute('lineOrder', 'lineOrder', struct.pack('<B', 0))
+        header += _exr_attribute('pixelAspectRatio', 'float', struct.pack('<f', 1.0))
+        header += _exr_attribute('screenWindowCenter', 'v2f', struct.pack('<ff', 0.0, 0.0))
+        header += _exr_attribute('screenWindowWidth', 'float', struct.pack('<f', 1.0))
+        header += b'\0'
+
+        self.filepath = filepath
+        self.file = open(filepath, 'wb')
+        self.file.write(header)
+
+        # the offsets of the chunks are filled in when closing
+        self._table = self.file.tell()
+        self._offsets = []
+        self.file.write(bytes(8 * self.chunks))
+
+        self._pending = np.empty((0, width, len(channels)), dtype=np.float16)
+        self._y = 0
+
+    @property
+    def chunks(self):
+        return (self.height + EXR_ZIP_LINES - 1) // EXR_ZIP_LINES
+
+    def write(self, rows):
+        """write the next rows, top row first"""
+        rows = np.asarray(rows).reshape(-1, self.width, len(self._order))
+        self._pending = np.concatenate((self._pending, rows[:, :, self._order].astype(np.float16)))
+
+        while len(self._pending) >= EXR_ZIP_LINES:
+            self._write_chunk(self._pending[:EXR_ZIP_LINES])
+            self._pending = self._pending[EXR_ZIP_LINES:]
+
+    def close(self):
+        """write the last rows and the chunk offsets"""
+        if not self.file:
+            return
+
+        if len(self._pending):
+            self._write_chunk(self._pending)
+
+        if self._y != self.height:
+            self.file.close()
+            self.file = None
+            raise ValueError("EXR file closed after {} of {} rows".format(self._y, self.height))
+
+        self.file.seek(self._table)
+        self.file.write(struct.pack('<{}Q'.format(len(self._offsets)), *self._offsets))
+        self.file.close()
+        self.file = None
+
+    def _write_chunk(self, lines):
+        # per scanline, one channel after the other
+        raw = np.ascontiguousarray(lines.transpose(0, 2, 1)).astype('<f2').tobytes()
+        data = _exr_zip(raw)
+
+        # data that doesn't compress is stored as is
+        if len(data) >= len(raw):
+            data = raw
+
+        self._offsets.append(self.file.tell())
+        self.file.write(struct.pack('<ii', self._y, len(data)))
+        self.file.write(data)
+
+        self._y += len(lines)
+
+    def discard(self):
+        """stop writing and remove the incomplete file"""
+        _discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.discard()
+
+class EXRReader:
+    """
+    memory-mapped OpenEXR reader, scanline or tiled (one level)
+    uncompressed, ZIPS or ZIP compressed, any pixel type
+
+    read_rows() decodes only the chunks or tiles covering the rows
+    """
+    def __init__(self, filepath, channels=('R', 'G', 'B')):
+        self.filepath = filepath
+
+        with open(filepath, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = struct.unpack_from('<ii', self._map, 0)
+        if magic != EXR_MAGIC:
+            raise ValueError("{} is not an OpenEXR file".format(filepath))
+
+        self.tiled = bool(version & EXR_TILED)
+        attributes, position = self._header(8)
+
+        # channels in file order with their type
+        self._channels = []
+        chlist = attributes['channels']
+        offset = 0
+        while chlist[offset] != 0:
+            end = chlist.index(b'\0', offset)
+            name = chlist[offset:end].decode()
+            pixel_type, = struct.unpack_from('<i', chlist, end + 1)
+            self._channels.append((name, pixel_type))
+            offset = end + 17
+
+        self.channels = channels
+        self._dtypes = {EXR_UINT: '<u4', EXR_HALF: '<f2', EXR_FLOAT: '<f4'}
+        self._pixel_size = sum(np.dtype(self._dtypes[pixel_type]).itemsize for name, pixel_type in self._channels)
+
+        self.compression = attributes['compression'][0]
+        if self.compression not in (EXR_NO_COMPRESSION, EXR_ZIPS_COMPRESSION, EXR_ZIP_COMPRESSION):
+            raise ValueError("EXR compression {} not supported".format(self.compression))
+
+        xmin, ymin, xmax, ymax = struct.unpack('<iiii', attributes['dataWindow'])
+        self.width = xmax - xmin + 1
+        self.height = ymax - ymin + 1
+
+        if self.tiled:
+            tile_width, tile_height, mode = struct.unpack('<IIB', attributes['tiles'])
+            if mode & 0xf:
+                raise ValueError("Only one level tiled EXR files are supported")
+
+            self.tile_width, self.tile_height = tile_width, tile_height
+            self._tiles_x = (self.width + tile_width - 1) // tile_width
+            chunks = self._tiles_x * ((self.height + tile_height - 1) // tile_height)
+            self.lines = tile_height
+
+        else:
+            self.lines = EXR_ZIP_LINES if self.compression == EXR_ZIP_COMPRESSION else 1
+            chunks = (self.height + self.lines - 1) // self.lines
+
+        self._offsets = np.frombuffer(self._map, dtype='<u8', count=chunks, offset=position)
+
+    def _header(self, position):
+        """attributes dictionary and the position after the header"""
+        attributes = {}
+
+        while self._map[position] != 0:
+            end = self._map.find(b'\0', position)
+            name = self._map[position:end].decode()
+            end = self._map.find(b'\0', end + 1)
+            size, = struct.unpack_from('<i', self._map, end + 1)
+            attributes[name] = self._map[end + 5:end + 5 + size]
+            position = end + 5 + size
+
+        return attributes, position + 1
+
+    def _decode(self, offset, header, width, lines):
+        """(lines, width, channels) float32 pixels of a chunk"""
+        size, = struct.unpack_from('<i', self._map, offset + header - 4)
+        data = self._map[offset + header:offset + header + size]
+
+        raw_size = width * lines * self._pixel_size
+        if self.compression != EXR_NO_COMPRESSION and size < raw_size:
+            data = _exr_unzip(data, raw_size)
+
+        # per scanline, one channel after the other
+        pixels = np.zeros((lines, width, len(self.channels)), dtype=np.float32)
+
+        line = 0
+        for y in range(lines):
+            for name, pixel_type in self._channels:
+                values = np.frombuffer(data, dtype=self._dtypes[pixel_type], count=width, offset=line)
+                line += values.nbytes
+
+                if name in self.channels:
+                    pixels[y, :, self.channels.index(name)] = values
+
+        return pixels
+
+    def read_rows(self, start, end):
+        """(end - start, width, channels) float32 rows, counted from the top"""
+        rows = np.empty((end - start, self.width, len(self.channels)), dtype=np.float32)
+
+        for chunk_y in range(start // self.lines, (end + self.lines - 1) // self.lines):
+            first = chunk_y * self.lines
+            lines = min(self.lines, self.height - first)
+
+            if self.tiled:
+                chunk = np.empty((lines, self.width, len(self.channels)), dtype=np.float32)
+                for tile_x in range(self._tiles_x):
+                    x = tile_x * self.tile_width
+                    width = min(self.tile_width, self.width - x)
+                    offset = self._offsets[chunk_y * self._tiles_x + tile_x]
+                    chunk[:, x:x + width] = self._decode(offset, 20, width, lines)
+
+            else:
+                chunk = self._decode(self._offsets[chunk_y], 8, self.width, lines)
+
+            low, high = max(start, first), min(end, first + lines)
+            rows[low - start:high - start] = chunk[low - first:high - first]
+
+        return rows
+
+    def close(self):
+        self._offsets = None
+        self._map.close()
+
+# ###############################
+#  Radiance HDR
+# ###############################
+
+def float_to_rgbe(pixels):
+    """(...,3) float array to (...,4) uint8 RGBE"""
+    pixels = np.maximum(np.asarray(pixels, dtype=np.float32)[..., :3], 0.0)
+    value = pixels.max(axis=-1)
+
+    mantissa, exponent = np.frexp(value)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.where(value > 1e-32, mantissa * 256.0 / value, 0.0)
+
+    rgbe = np.empty(pixels.shape[:-1] + (4,), dtype=np.uint8)
+    rgbe[..., :3] = np.minimum(pixels * scale[..., None], 255.0)
+    rgbe[..., 3] = np.where(value > 1e-32, exponent + 128, 0)
+    return rgbe
+
+def rgbe_to_float(rgbe):
+    """(...,4) uint8 RGBE array to (...,3) float32"""
+    rgbe = np.asarray(rgbe)
+    exponent = rgbe[..., 3].astype(np.int32)
+    scale = np.where(exponent > 0, np.ldexp(np.float32(1.0), exponent - 136), 0.0).astype(np.float32)
+    return rgbe[..., :3] * scale[..., None]
+
+def _decode_runs(data, positions, counts):
+    """
+    bytes of consecutive RLE runs, all at once
+    positions : offset of the run headers in data
+    counts : pixels of each run, negative for the repeated runs
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+
+    repeated = counts < 0
+    counts = np.abs(counts)
+
+    values = np.empty(counts.sum(), dtype=np.uint8)
+    repeated_values = np.repeat(repeated, counts)
+
+    # a repeated run has a single value after its header
+    values[repeated_values] = np.repeat(data[positions[repeated] + 1], counts[repeated])
+
+    # the literal values follow their header, they are all picked with a mask of the bytes
+    start = positions[0]
+    first = positions[~repeated] + 1 - start
+    last = first + counts[~repeated]
+
+    if len(first):
+        marks = np.zeros(last[-1] + 1, dtype=np.int8)
+        marks[first] = 1
+        marks[last] = -1
+
+        literal = np.cumsum(marks[:-1], dtype=np.int8).view(np.bool_)
+        values[~repeated_values] = data[start:start + len(literal)][literal]
+
+    return values
+
+class HDRReader:
+    """
+    memory-mapped Radiance RGBE reader, run length encoded or flat scanlines
+
+    the scanline offsets are indexed once, as far as needed, and
+    read_rows() only decodes the requested rows: the run headers are
+    walked, then the runs of all the rows are expanded at once
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+        with open(filepath, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if not self._map[:2] == b'#?':
+            raise ValueError("{} is not a Radiance file".format(filepath))
+
+        # the header ends with an empty line, then the resolution
+        position = self._map.find(b'\n\n')
+        end = self._map.find(b'\n', position + 2)
+        resolution = self._map[position + 2:end].split()
+
+        if len(resolution) != 4 or resolution[0] != b'-Y' or resolution[2] != b'+X':
+            raise ValueError("Radiance orientation {} not supported".format(b' '.join(resolution)))
+
+        self.height = int(resolution[1])
+        self.width = int(resolution[3])
+
+        self._data = np.frombuffer(self._map, dtype=np.uint8)
+
+        # offset of each scanline, filled in as they are needed
+        self._offsets = [end + 1]
+        self._lock = threading.Lock()
+
+    def _is_rle(self, offset):
+        data = self._data[offset:offset + 4]
+        return 8 <= self.width <= 0x7fff and len(data) == 4 and \
+                data[0] == 2 and data[1] == 2 and not data[2] & 0x80 and \
+                (int(data[2]) << 8 | int(data[3])) == self.width
+
+    def _walk(self, offset, positions=None, counts=None):
+        """
+        offset after the RLE scanline starting at offset, only the run headers are visited
+        positions, counts : lists the run headers and pixel counts are appended to,
+        negative counts for the repeated runs
+        """
+        data = self._map
+        offset += 4
+        x = 0
+        pixels = 4 * self.width
+
+        # the 4 components are run length encoded one after the other
+        while x < pixels:
+            count = data[offset]
+
+            if count > 128:
+                count -= 128
+                if positions is not None:
+                    positions.append(offset)
+                    counts.append(-count)
+                offset += 2
+
+            else:
+                if positions is not None:
+                    positions.append(offset)
+                    counts.append(count)
+                offset += 1 + count
+
+            x += count
+
+        return offset
+
+    def _index(self, row):
+        """find the offset of the scanlines up to row"""
+        offsets = self._offsets
+
+        while len(offsets) <= row:
+            offset = offsets[-1]
+
+            if self._is_rle(offset):
+                offsets.append(self._walk(offset))
+            else:
+                offsets.append(offset + 4 * self.width)
+
+    def read_rows(self, start, end):
+        """(end - start, width, 3) float32 rows, counted from the top"""
+        # the rows can be read from several threads, only the index is shared
+        with self._lock:
+            self._index(start)
+
+        rgbe = np.empty((end - start, 4, self.width), dtype=np.uint8)
+        offset = self._offsets[start]
+
+        rle = []
+        positions = []
+        counts = []
+
+        for row in range(start, end):
+            if self._is_rle(offset):
+                rle.append(row - start)
+                next_offset = self._walk(offset, positions, counts)
+
+            else:
+                next_offset = offset + 4 * self.width
+                rgbe[row - start] = self._data[offset:next_offset].reshape(self.width, 4).T
+
+            # the scanlines are indexed along the way
+            if row + 1 == len(self._offsets):
+                with self._lock:
+                    if row + 1 == len(self._offsets):
+                        self._offsets.append(next_offset)
+
+            offset = next_offset
+
+        if rle:
+            rgbe[rle] = _decode_runs(self._data, positions, counts).reshape(len(rle), 4, self.width)
+
+        return rgbe_to_float(rgbe.transpose(0, 2, 1))
+
+    def close(self):
+        self._data = None
+        self._map.close()
+
+class HDRWriter:
+    """
+    Radiance RGBE writer, run length encoded scanlines
+
+    rows are written with write() as (N, width, 3+) float arrays,
+    top row first
+    """
+    def __init__(self, filepath, width, height):
+        self.width = width
+        self.height = height
+
+        self.filepath = filepath
+        self.file = open(filepath, 'wb')
+        self.file.write(b'#?RADIANCE\nFORMAT=32-bit_rle_rgbe\n\n')
+        self.file.write('-Y {} +X {}\n'.format(height, width).encode())
+
+        self._y = 0
+
+        # the run length encoding only exists for these widths
+        self._rle = 8 <= width <= 0x7fff
+
+        # every component goes in literal runs of at most 128 bytes
+        runs = (width + 127) // 128
+        self._counts = np.full(runs, 128, dtype=np.uint8)
+        self._counts[-1] = width - 128 * (runs - 1)
+        self._starts = np.arange(runs) * 129
+
+    def write(self, rows):
+        """write the next rows, top row first"""
+        rgbe = float_to_rgbe(np.asarray(rows).reshape(-1, self.width, np.shape(rows)[-1]))
+
+        if self._rle:
+            rgbe = self._encode(rgbe)
+
+        self.file.write(rgbe.tobytes())
+        self._y += len(rows)
+
+    def _encode(self, rgbe):
+        """new style run length encoding, all literals"""
+        lines = len(rgbe)
+        runs = len(self._counts)
+
+        # scanline marker followed by the 4 components, one after the other
+        data = np.empty((lines, 4 + 4 * (self.width + runs)), dtype=np.uint8)
+        data[:, 0:2] = 2
+        data[:, 2] = self.width >> 8
+        data[:, 3] = self.width & 0xff
+
+        components = data[:, 4:].reshape(lines, 4, self.width + runs)
+        literals = np.ones(self.width + runs, dtype=bool)
+        literals[self._starts] = False
+
+        components[:, :, self._starts] = self._counts
+        components[:, :, literals] = rgbe.transpose(0, 2, 1)
+        return data
+
+    def close(self):
+        if not self.file:
+            return
+
+        self.file.close()
+        self.file = None
+
+        if self._y != self.height:
+            raise ValueError("HDR file closed after {} of {} rows".format(self._y, self.height))
+
+    def discard(self):
+        """stop writing and remove the incomplete file"""
+        _discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.discard()
+
+def _discard(writer):
+    if not writer.file:
+        return
+
+    writer.file.close()
+    writer.file = None
+    os.remove(writer.filepath)
+
+def open_writer(filepath, width, height, channels=('R', 'G', 'B', 'A')):
+    """
+    writer for the file extension, .hdr for Radiance, OpenEXR otherwise
+    channels : OpenEXR channel names, Radiance files are always RGB
+    """
+    if filepath.lower().endswith('.hdr'):
+        return HDRWriter(filepath, width, height)
+    return EXRWriter(filepath, width, height, channels)
+
+def open_image(filepath):
+    """memory-mapped reader for a Radiance or OpenEXR file"""
+    with open(filepath, 'rb') as file:
+        magic = file.read(4)
+
+    if magic == struct.pack('<i', EXR_MAGIC):
+        return EXRReader(filepath)
+    return HDRReader(filepath)
+
+def row_reader(source):
+    """
+    read_rows function, width and height of a reader,
+    or of a (height, width, channels) numpy/memmap array
+    """
+    if hasattr(source, 'read_rows'):
+        return source.read_rows, source.width, source.height
+
+    return (lambda start, end: np.asarray(source[start:end])), source.shape[1], source.shape[0]
+
+def read_downsampled(source, width, band_height=64):
+    """
+    box filtered (height, width, 3) float copy of a reader or array, read a band at a time
+    the width is rounded to an integer factor of the source width
+    """
+    read_rows, source_width, source_height = row_reader(source)
+
+    factor = max(1, source_width // width)
+    width = source_width // factor
+    height = source_height // factor
+
+    pixels = np.empty((height, width, 3))
+    lines = max(1, band_height // factor)
+
+    for y in range(0, height, lines):
+        end = min(y + lines, height)
+        band = read_rows(y * factor, end * factor)[:, :width * factor, :3]
+        pixels[y:end] = band.reshape(end - y, factor, width, factor, 3).mean(axis=(1, 3))
+
+    return pixels
+
+def replace_file(source, destination):
+    """move source over destination, os.replace is not in Python 3.2"""
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+        return
+
+    if os.name == 'nt' and os.path.exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
+
+def file_hash(filepath, block_size=1 << 22):
+    """sha1 hex digest of the file content"""
+    sha1 = hashlib.sha1()
+
+    with open(filepath, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+# ###############################
+#  PNG
+# ###############################
+
+def write_png(filepath, pixels):
+    """save a (height, width, 3) uint8 array, top row first, as PNG"""
+    height, width, channels = pixels.shape
+    color_type = {1: 0, 3: 2, 4: 6}[channels]
+
+    def chunk(type, data):
+        return struct.pack('>I', len(data)) + type + data + \
+                struct.pack('>I', zlib.crc32(type + data) & 0xffffffff)
+
+    # every scanline starts with its filter type (none)
+    lines = np.zeros((height, 1 + width * channels), dtype=np.uint8)
+    lines[:, 1:] = pixels.reshape(height, -1)
+
+    with open(filepath, 'wb') as file:
+        file.write(b'\x89PNG\r\n\x1a\n')
+        file.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)))
+        file.write(chunk(b'IDAT', zlib.compress(lines.tobytes(), 6)))
+        file.write(chunk(b'IEND', b''))
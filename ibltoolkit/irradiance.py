@@ -0,0 +1,105 @@
+"""
+Spherical harmonics irradiance of the environment.
+
+The calibrated panorama is projected on the real spherical harmonics
+basis (order 2: 4 coefficients, order 3: 9 coefficients per channel)
+with the pixels solid angle as weights, a band of rows at a time. The
+diffuse irradiance of any normal is then a dot product with the basis
+(Ramamoorthi and Hanrahan, An Efficient Representation for Irradiance
+Environment Maps).
+"""
+
+import numpy as np
+
+from . import panorama
+from . import imagefile
+
+# the panorama is box filtered down to it, plenty for the low frequencies
+PROJECTION_WIDTH = 512
+
+# panorama rows projected at once
+BAND_HEIGHT = 64
+
+# convolution with the clamped cosine, per band l
+COSINE_LOBE = (np.pi, 2.0 * np.pi / 3.0, np.pi / 4.0)
+
+# ###############################
+#  Basis
+# ###############################
+
+def sh_basis(directions, order=3):
+    """
+    real spherical harmonics of (N,3) unit directions
+    returns a (N, order * order) array
+    """
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    x, y, z = directions[:, 0], directions[:, 1], directions[:, 2]
+
+    basis = np.empty((len(directions), order * order))
+    basis[:, 0] = 0.282095
+
+    if order > 1:
+        basis[:, 1] = 0.488603 * y
+        basis[:, 2] = 0.488603 * z
+        basis[:, 3] = 0.488603 * x
+
+    if order > 2:
+        basis[:, 4] = 1.092548 * x * y
+        basis[:, 5] = 1.092548 * y * z
+        basis[:, 6] = 0.315392 * (3.0 * z * z - 1.0)
+        basis[:, 7] = 1.092548 * x * z
+        basis[:, 8] = 0.546274 * (x * x - y * y)
+
+    return basis
+
+def _bands(order):
+    """band l of every coefficient"""
+    return np.repeat(np.arange(order), 2 * np.arange(order) + 1)
+
+# ###############################
+#  Projection
+# ###############################
+
+def project(source, euler=(0.0, 0.0, 0.0), order=3, width=PROJECTION_WIDTH):
+    """
+    radiance coefficients of a panorama reader or (height, width, channels) array
+    euler : calibration orientation, the coefficients are in world space
+    returns a (order * order, 3) array
+    """
+    if order not in (2, 3):
+        raise ValueError("order must be 2 or 3, not {}".format(order))
+
+    pixels = imagefile.read_downsampled(source, width)
+    height, width = pixels.shape[:2]
+
+    matrix = panorama.euler_to_matrix(euler)
+    theta = (np.arange(height) + 0.5) * (np.pi / height)
+    solid_angle = np.sin(theta) * (np.pi / height) * (2.0 * np.pi / width)
+
+    u = (np.arange(width) + 0.5) / width
+    coefficients = np.zeros((order * order, 3))
+
+    for start in range(0, height, BAND_HEIGHT):
+        end = min(start + BAND_HEIGHT, height)
+
+        uv = np.empty((end - start, width, 2))
+        uv[:, :, 0] = u[None, :]
+        uv[:, :, 1] = (1.0 - (np.arange(start, end) + 0.5) / height)[:, None]
+
+        directions = panorama.rotate(panorama.equirectangular_to_sphere(uv.reshape(-1, 2)), matrix)
+        weights = np.repeat(solid_angle[start:end], width)[:, None]
+
+        radiance = pixels[start:end, :, :3].reshape(-1, 3) * weights
+        coefficients += sh_basis(directions, order).T.dot(radiance)
+
+    return coefficients
+
+def irradiance(coefficients, normals):
+    """
+    diffuse irradiance of (N,3) unit normals from the radiance coefficients
+    returns a (N,3) array, divide by pi for the radiance of a white lambertian surface
+    """
+    order = int(round(np.sqrt(len(coefficients))))
+    lobe = np.take(COSINE_LOBE, _bands(order))
+
+    return sh_basis(normals, order).dot(coefficients * lobe[:, None])
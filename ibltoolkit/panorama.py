@@ -0,0 +1,144 @@
+"""
+Vectorized panorama geometry.
+
+Batched counterparts of the calibrate.py projection functions. They
+work on (N,2) uv and (N,3) point arrays and do not depend on bpy, so
+they can be used from worker processes and headless tools as well.
+"""
+
+import numpy as np
+
+# ###############################
+#  Rotation Functions
+# ###############################
+
+def euler_to_matrix(euler):
+    """
+    3x3 rotation matrix of an XYZ euler,
+    same convention as mathutils.Euler.to_matrix()
+    """
+    x, y, z = (float(angle) for angle in euler[:3])
+
+    cx, sx = np.cos(x), np.sin(x)
+    cy, sy = np.cos(y), np.sin(y)
+    cz, sz = np.cos(z), np.sin(z)
+
+    rx = np.array(((1.0, 0.0, 0.0), (0.0, cx, -sx), (0.0, sx, cx)))
+    ry = np.array(((cy, 0.0, sy), (0.0, 1.0, 0.0), (-sy, 0.0, cy)))
+    rz = np.array(((cz, -sz, 0.0), (sz, cz, 0.0), (0.0, 0.0, 1.0)))
+
+    return rz.dot(ry).dot(rx)
+
+def rotate(verts, matrix):
+    """apply a 3x3 matrix to a (N,3) array of points"""
+    return np.asarray(verts, dtype=np.float64).dot(np.asarray(matrix).T)
+
+# ###############################
+#  Geometry Functions
+# ###############################
+
+def equirectangular_to_sphere(uv):
+    """
+    convert (N,2) 2d points to (N,3) 3d points
+    uv : 0,0 (bottom left) 1,1 (top right)
+    uv : +pi, -pi/2 (bottom left) -pi, +pi/2 (top right)
+    """
+    uv = np.asarray(uv, dtype=np.float64).reshape(-1, 2)
+
+    phi = (0.5 - uv[:, 0]) * (2 * np.pi)
+    theta = (uv[:, 1] - 0.5) * np.pi
+    r = np.cos(theta)
+
+    verts = np.empty((len(uv), 3))
+    verts[:, 0] = np.cos(phi) * r
+    verts[:, 1] = np.sin(phi) * r
+    verts[:, 2] = np.sin(theta)
+
+    return verts
+
+def sphere_to_equirectangular(verts):
+    """
+    convert (N,3) 3d points to (N,2) uv
+    """
+    verts = np.asarray(verts, dtype=np.float64).reshape(-1, 3)
+
+    # clip to protect asin from rounding errors of normalized vectors
+    theta = np.arcsin(np.clip(verts[:, 2], -1.0, 1.0))
+    phi = np.arctan2(verts[:, 1], verts[:, 0])
+
+    uv = np.empty((len(verts), 2))
+    uv[:, 0] = -0.5 * (phi / np.pi - 1)
+    uv[:, 1] = 0.5 * (2 * theta / np.pi + 1)
+
+    return uv
+
+def sphere_to_3d(verts, euler, radius):
+    """
+    given (N,3) points in the sphere and the euler inclination of the pole
+    calculates the projected points in the plane
+    """
+    verts = rotate(verts, euler_to_matrix(euler)).reshape(-1, 3)
+
+    # the ray leaves (0, 0, radius) and hits the floor at z = 0
+    t = -radius / verts[:, 2:3]
+
+    floor = verts * t
+    floor[:, 2] += radius
+    return floor
+
+def _3d_to_sphere(verts, euler, radius):
+    """
+    given (N,3) points in the 3d world and the euler inclination of the pole
+    calculates the (not normalized) points in the sphere
+    """
+    verts = np.array(verts, dtype=np.float64).reshape(-1, 3)
+    verts[:, 2] -= radius
+    verts /= radius
+
+    # the inverse of a rotation matrix is its transpose
+    return verts.dot(euler_to_matrix(euler))
+
+def normalize(verts):
+    """normalize a (N,3) array of vectors"""
+    verts = np.asarray(verts, dtype=np.float64)
+    length = np.sqrt(np.einsum('ij,ij->i', verts, verts))
+    length[length == 0.0] = 1.0
+    return verts / length[:, None]
+
+# ###############################
+#  Sampling
+# ###############################
+
+def sample_bilinear(image, uv, start=0, height=None):
+    """
+    bilinear lookup of (N,2) uv in a (height, width, ...) panorama array
+    the array is stored top row first, as read from the files (numpy or memmap)
+    wraps around horizontally and clamps at the poles
+    start, height : when the array is only a band of rows of the panorama, its
+    first row and the panorama height. The band has to cover the looked up rows
+    returns a (N, ...) float32 array
+    """
+    rows, width = image.shape[:2]
+    height = height or rows
+    uv = np.asarray(uv, dtype=np.float64).reshape(-1, 2)
+
+    # pixel centers are at .5
+    x = uv[:, 0] * width - 0.5
+    y = (1.0 - uv[:, 1]) * height - 0.5
+
+    x0 = np.floor(x)
+    y0 = np.floor(y)
+
+    shape = (-1,) + (1,) * (image.ndim - 2)
+    fx = (x - x0).astype(np.float32).reshape(shape)
+    fy = (y - y0).astype(np.float32).reshape(shape)
+
+    x0 = x0.astype(np.int64) % width
+    x1 = (x0 + 1) % width
+    y1 = np.clip(y0.astype(np.int64) + 1, 0, height - 1) - start
+    y0 = np.clip(y0.astype(np.int64), 0, height - 1) - start
+
+    top = image[y0, x0] * (1.0 - fx) + image[y0, x1] * fx
+    bottom = image[y1, x0] * (1.0 - fx) + image[y1, x1] * fx
+
+    return (top * (1.0 - fy) + bottom * fy).astype(np.float32, copy=False)
@@ -0,0 +1,209 @@
+"""
+LDR proxies of HDR panoramas.
+
+The 3D view background only works with LDR images. The proxies are
+tonemapped and downsampled copies of the HDR, generated in a background
+thread and cached on disk by source file hash and tonemap parameters.
+Float proxies (not tonemapped, as .npy) are kept the same way for the
+environment analysis, so it doesn't decode the whole HDR every time.
+The least recently used ones are removed when the cache grows too big.
+"""
+
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import imagefile
+
+# proxy width, big enough for the viewport
+PROXY_WIDTH = 2048
+
+# disk space used by the cached proxies
+CACHE_SIZE = 256 * 1024 * 1024
+
+# panorama rows decoded at once
+BAND_HEIGHT = 64
+
+# float proxy width, the environment analysis (sun, irradiance) works at this size
+ANALYSIS_WIDTH = 1024
+
+# ###############################
+#  Proxy Generation
+# ###############################
+
+def tonemap(pixels, exposure=0.0, gamma=2.2):
+    """Reinhard tonemap of linear float pixels to uint8"""
+    pixels = np.maximum(pixels, 0.0) * (2.0 ** exposure)
+    pixels = (pixels / (1.0 + pixels)) ** (1.0 / gamma)
+    return (pixels * 255.0 + 0.5).astype(np.uint8)
+
+def make_proxy(filepath, width=PROXY_WIDTH, exposure=0.0, gamma=2.2):
+    """
+    tonemapped and box filtered (height, width, 3) uint8 proxy, top row first
+    the panorama is read a band at a time
+    """
+    reader = imagefile.open_image(filepath)
+
+    try:
+        factor = max(1, reader.width // width)
+        width = reader.width // factor
+        height = reader.height // factor
+
+        proxy = np.empty((height, width, 3), dtype=np.uint8)
+        lines = max(1, BAND_HEIGHT // factor)
+
+        for y in range(0, height, lines):
+            end = min(y + lines, height)
+            band = reader.read_rows(y * factor, end * factor)[:, :width * factor, :3]
+            band = band.reshape(end - y, factor, width, factor, 3).mean(axis=(1, 3))
+            proxy[y:end] = tonemap(band, exposure, gamma)
+
+    finally:
+        reader.close()
+
+    return proxy
+
+def make_float_proxy(filepath, width=ANALYSIS_WIDTH):
+    """box filtered (height, width, 3) float32 copy, top row first, not tonemapped"""
+    reader = imagefile.open_image(filepath)
+
+    try:
+        return imagefile.read_downsampled(reader, width, BAND_HEIGHT).astype(np.float32)
+    finally:
+        reader.close()
+
+# ###############################
+#  Disk Cache
+# ###############################
+
+class ProxyCache:
+    """proxies on disk, keyed by source hash and parameters, least recently used eviction"""
+    def __init__(self, directory, max_size=CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._hashes = {}
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _key(self, filepath, parameters):
+        # hashing a big HDR is slow, only do it again if the file changed
+        stat = os.stat(filepath)
+        signature = (filepath, stat.st_size, stat.st_mtime)
+
+        if signature not in self._hashes:
+            self._hashes[signature] = imagefile.file_hash(filepath)
+
+        parameters = "{}:{}".format(self._hashes[signature], parameters)
+        return hashlib.sha1(parameters.encode()).hexdigest()
+
+    def _cached(self, path):
+        """if the proxy is in the cache, marked as recently used"""
+        if not os.path.exists(path):
+            return False
+
+        os.utime(path, None)
+        return True
+
+    def get(self, filepath, width=PROXY_WIDTH, exposure=0.0, gamma=2.2):
+        """path of the proxy, generated if not in the cache"""
+        key = self._key(filepath, "{}:{:.4f}:{:.4f}".format(width, exposure, gamma))
+        path = os.path.join(self.directory, key + ".png")
+
+        if self._cached(path):
+            return path
+
+        temp = path + ".tmp"
+        imagefile.write_png(temp, make_proxy(filepath, width, exposure, gamma))
+        imagefile.replace_file(temp, path)
+
+        self.evict()
+        return path
+
+    def get_float(self, filepath, width=ANALYSIS_WIDTH):
+        """path of the float proxy (.npy), generated if not in the cache"""
+        path = os.path.join(self.directory, self._key(filepath, "float:{}".format(width)) + ".npy")
+
+        if self._cached(path):
+            return path
+
+        # np.save adds the extension to names without it
+        temp = path[:-len(".npy")] + ".tmp.npy"
+        np.save(temp, make_float_proxy(filepath, width))
+        imagefile.replace_file(temp, path)
+
+        self.evict()
+        return path
+
+    def evict(self):
+        """remove the least recently used proxies over the cache size"""
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith((".png", ".npy")) or name.endswith(".tmp.npy"):
+                continue
+
+            stat = os.stat(os.path.join(self.directory, name))
+            files.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for time, size, name in files)
+
+        # always keep the most recent one
+        for time, size, name in sorted(files)[:-1]:
+            if total <= self.max_size:
+                break
+
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+# ###############################
+#  Background Worker
+# ###############################
+
+# started by the first request, stopped by shutdown()
+_executor = None
+_jobs = {}
+
+def request(cache, filepath, width=PROXY_WIDTH, exposure=0.0, gamma=2.2):
+    """
+    start generating the proxy in the background (if not already)
+    returns a future with the proxy path
+    """
+    job = (cache.directory, filepath, os.stat(filepath).st_mtime, 'png', width, exposure, gamma)
+    return _submit(job, cache.get, filepath, width, exposure, gamma)
+
+def request_float(cache, filepath, width=ANALYSIS_WIDTH):
+    """
+    start generating the float proxy in the background (if not already)
+    returns a future with the proxy path
+    """
+    job = (cache.directory, filepath, os.stat(filepath).st_mtime, 'npy', width)
+    return _submit(job, cache.get_float, filepath, width)
+
+def _submit(job, function, *args):
+    """future of the job, submitted again if it failed or its file was evicted"""
+    # running, or done and still in the cache
+    future = _jobs.get(job)
+    if future and (not future.done() or \
+            (not future.exception() and os.path.exists(future.result()))):
+        return future
+
+    global _executor
+    if not _executor:
+        _executor = ThreadPoolExecutor(1)
+
+    future = _executor.submit(function, *args)
+    _jobs[job] = future
+    return future
+
+def shutdown():
+    """drop the queued proxies and stop the worker, the running one is left to finish"""
+    global _executor
+
+    for future in _jobs.values():
+        future.cancel()
+    _jobs.clear()
+
+    if _executor:
+        _executor.shutdown(wait=False)
+        _executor = None
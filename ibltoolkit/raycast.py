@@ -0,0 +1,130 @@
+"""
+CPU ray casting of equirectangular panoramas.
+
+Casts one ray per panorama pixel from the calibrated camera position
+against the support geometry. Pure numpy, no bpy, so it runs headless
+and without any render engine.
+"""
+
+import numpy as np
+
+from . import panorama
+
+# depth stored for the pixels that miss all the geometry (same as Cycles)
+DEPTH_MISS = 1e10
+
+# maximum number of ray/triangle pairs tested at once
+PAIRS_PER_CHUNK = 1 << 21
+
+# ###############################
+#  Ray / Triangle Intersection
+# ###############################
+
+def ray_triangle(origins, directions, v0, e1, e2, epsilon=1e-12):
+    """
+    Moller-Trumbore intersection, two sided
+    all the arguments are (...,3) arrays broadcast against each other
+    e1, e2 are the triangle edges (v1 - v0) and (v2 - v0)
+    returns the ray distance, inf where there is no hit
+    """
+    pvec = np.cross(directions, e2)
+    det = np.einsum('...i,...i->...', e1, pvec)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_det = 1.0 / det
+
+        tvec = origins - v0
+        u = np.einsum('...i,...i->...', tvec, pvec) * inv_det
+
+        qvec = np.cross(tvec, e1)
+        v = np.einsum('...i,...i->...', directions, qvec) * inv_det
+        t = np.einsum('...i,...i->...', e2, qvec) * inv_det
+
+    hit = (np.abs(det) > epsilon) & \
+          (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & \
+          (t > epsilon)
+
+    return np.where(hit, t, np.inf)
+
+def triangle_edges(triangles):
+    """(T,3,3) triangles to the v0, e1, e2 arrays used by ray_triangle"""
+    triangles = np.asarray(triangles, dtype=np.float64)
+    v0 = triangles[:, 0]
+    return v0, triangles[:, 1] - v0, triangles[:, 2] - v0
+
+def intersect(origins, directions, triangles):
+    """
+    brute force closest hit of (N,3) rays against (T,3,3) triangles
+    returns the (N,) distances (inf for no hit) and the triangle index (-1)
+    """
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    origins = np.broadcast_to(np.asarray(origins, dtype=np.float64), directions.shape)
+
+    distance = np.full(len(directions), np.inf)
+    index = np.full(len(directions), -1, dtype=np.int64)
+
+    if not len(triangles):
+        return distance, index
+
+    v0, e1, e2 = triangle_edges(triangles)
+
+    tris_per_chunk = min(len(v0), 256)
+    rays_per_chunk = max(1, PAIRS_PER_CHUNK // tris_per_chunk)
+
+    for ray_start in range(0, len(directions), rays_per_chunk):
+        rays = slice(ray_start, ray_start + rays_per_chunk)
+        o = origins[rays, None, :]
+        d = directions[rays, None, :]
+
+        # views, updated in place
+        ray_distance = distance[rays]
+        ray_index = index[rays]
+
+        for tri_start in range(0, len(v0), tris_per_chunk):
+            tris = slice(tri_start, tri_start + tris_per_chunk)
+            t = ray_triangle(o, d, v0[None, tris], e1[None, tris], e2[None, tris])
+
+            closest = np.argmin(t, axis=1)
+            t = t[np.arange(len(t)), closest]
+
+            better = t < ray_distance
+            ray_distance[better] = t[better]
+            ray_index[better] = closest[better] + tri_start
+
+    return distance, index
+
+# ###############################
+#  Panorama Rendering
+# ###############################
+
+def panorama_directions(width, height, euler, rows=None):
+    """
+    world space direction of the center of every panorama pixel
+    rows : (start, end) pixel rows, counted from the bottom like in Blender
+    returns a (end - start, width, 3) array
+    """
+    start, end = rows or (0, height)
+
+    uv = np.empty((end - start, width, 2))
+    uv[:, :, 0] = ((np.arange(width) + 0.5) / width)[None, :]
+    uv[:, :, 1] = ((np.arange(start, end) + 0.5) / height)[:, None]
+
+    verts = panorama.equirectangular_to_sphere(uv.reshape(-1, 2))
+    verts = panorama.rotate(verts, panorama.euler_to_matrix(euler))
+
+    return verts.reshape(end - start, width, 3)
+
+def render_depth(geometry, width, height, euler, camera_height, rows=None):
+    """
+    distance from the camera to the geometry for every panorama pixel
+    geometry : bvh.BVH (or anything with the same intersect method)
+    rows : (start, end) pixel rows, counted from the bottom like in Blender
+    returns a (end - start, width) float32 array
+    """
+    directions = panorama_directions(width, height, euler, rows)
+    origin = np.array((0.0, 0.0, camera_height))
+
+    distance, index = geometry.intersect(origin, directions.reshape(-1, 3))
+    distance[index == -1] = DEPTH_MISS
+
+    return distance.reshape(directions.shape[:2]).astype(np.float32)
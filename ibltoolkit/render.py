@@ -1,11 +1,23 @@
+import os
+
 import bpy
-from bpy.props import StringProperty, IntProperty, EnumProperty
+from bpy.props import StringProperty, IntProperty, EnumProperty, FloatVectorProperty
 from bpy_extras.io_utils import ExportHelper
 
 from mathutils import Euler, Vector
 from math import pi
 
-from .calibrate import get_image, _3d_to_sphere, sphere_to_equirectangular
+import numpy as np
+
+from . import panorama
+from . import imagefile
+from . import tiles
+from . import cubemap
+from . import bake
+from . import sampling
+from . import irradiance
+from .bvh import BVH
+from .calibrate import get_image, get_panorama, get_analysis_pixels, panorama_pixels, image_pixels, HDR_EXTENSIONS
 
 class PanoramaCamera(bpy.types.Operator):
     """"""
@@ -67,38 +79,31 @@ class OBJECT_OT_project_environment_uv(bpy.types.Operator):
                     context_clip(context)
 
     def execute(self, context):
-        import bmesh
-
         scene = context.scene
         movieclip = context.edit_movieclip
         settings = movieclip.ibl_settings
 
         object = context.active_object
         mesh = object.data
-   
+
         uv = mesh.uv_textures.active
         if not uv:  uv = mesh.uv_textures.new()
+        uv_layer = mesh.uv_layers.active
 
-        # get a BMesh representation
-        bm = bmesh.new()
-        bm.from_mesh(mesh)
+        # read all the loops at once and project them in one pass
+        verts = mesh_world_coordinates(object)
 
-        uv_layer = bm.loops.layers.uv.active
+        vertex_index = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get('vertex_index', vertex_index)
 
-        for face in bm.faces:
-            for loop in face.loops:
-                uv_loop = loop[uv_layer]
-                vert = object.matrix_world * Vector(loop.vert.co[:])
-                orientation =  settings.orientation
-                uv_loop.uv = sphere_to_equirectangular( \
-                    _3d_to_sphere(vert, \
-                    orientation, settings.camera_height).normalized())
+        sphere = panorama._3d_to_sphere(verts, settings.orientation, settings.camera_height)
+        uvs = panorama.sphere_to_equirectangular(panorama.normalize(sphere))
 
-        # Finish up, write the bmesh back to the mesh
-        bm.to_mesh(mesh)
+        uv_layer.data.foreach_set('uv', uvs[vertex_index].astype(np.float32).ravel())
+        mesh.update()
 
         return {'FINISHED'}
-        
+
 
 class OBJECT_OT_save_position(bpy.types.Operator):
     """"""
@@ -116,32 +121,12 @@ class OBJECT_OT_save_position(bpy.types.Operator):
                     context_clip(context)
 
     def execute(self, context):
-        import bmesh
-
-        scene = context.scene
-        movieclip = context.edit_movieclip
-        settings = movieclip.ibl_settings
-
         object = context.active_object
         mesh = object.data
-   
-        # get a BMesh representation
-        bm = bmesh.new()
-        bm.from_mesh(mesh)
-
-        x=bm.loops.layers.float.new('X')
-        y=bm.loops.layers.float.new('Y')
-        z=bm.loops.layers.float.new('Z')
-        
-        for face in bm.faces:
-            for loop in face.loops:
-                vert = object.matrix_world * Vector(loop.vert.co[:])
-                loop[x] = vert.x
-                loop[y] = vert.y
-                loop[z] = vert.z
 
-        # Finish up, write the bmesh back to the mesh
-        bm.to_mesh(mesh)
+        # the LuxRender exporter only reads the per-loop layers
+        save_loop_position(mesh, mesh_world_coordinates(object))
+        mesh.update()
 
         return {'FINISHED'}
 
@@ -163,27 +148,66 @@ class OBJECT_OT_reset_position(bpy.types.Operator):
     def execute(self, context):
         import bmesh
 
-        scene = context.scene
-        movieclip = context.edit_movieclip
-        settings = movieclip.ibl_settings
-
         object = context.active_object
         mesh = object.data
-   
-        # get a BMesh representation
+
+        # the loop layers can only be removed through BMesh
         bm = bmesh.new()
         bm.from_mesh(mesh)
 
-        for i in ('X', 'Y', 'Z'):
-            layer = bm.loops.layers.float.get(i)
+        layers = bm.loops.layers.float
+        for name in POSITION_LAYERS:
+            layer = layers.get(name)
             if layer:
-                bm.loops.layers.float.remove(layer)
+                layers.remove(layer)
 
         # Finish up, write the bmesh back to the mesh
         bm.to_mesh(mesh)
 
         return {'FINISHED'}
 
+POSITION_LAYERS = ('X', 'Y', 'Z')
+
+def save_loop_position(mesh, verts):
+    """
+    per-loop X/Y/Z float layers with the (N,3) world position of the loops vertex,
+    as read by the LuxRender exporter. The loop layers are not in the Mesh API,
+    BMesh is the only way to write them, so it goes one loop at a time
+    """
+    import bmesh
+
+    bm = bmesh.new()
+    bm.from_mesh(mesh)
+
+    layers = []
+    for name in POSITION_LAYERS:
+        layer = bm.loops.layers.float.get(name)
+        if not layer: layer = bm.loops.layers.float.new(name)
+        layers.append(layer)
+
+    x, y, z = layers
+    verts = verts.tolist()
+
+    for face in bm.faces:
+        for loop in face.loops:
+            loop[x], loop[y], loop[z] = verts[loop.vert.index]
+
+    bm.to_mesh(mesh)
+
+def matrix_to_array(matrix):
+    """convert a mathutils.Matrix to a numpy array"""
+    return np.array([tuple(row) for row in matrix], dtype=np.float64)
+
+def mesh_world_coordinates(object):
+    """(N,3) array with the world coordinates of the mesh vertices"""
+    mesh = object.data
+
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', co)
+
+    matrix = matrix_to_array(object.matrix_world)
+    return co.reshape(-1, 3).dot(matrix[:3, :3].T) + matrix[:3, 3]
+
 def is_object_visible(ob, scene):
     """"""
     if ob.hide: return False
@@ -194,6 +218,56 @@ def is_object_visible(ob, scene):
 
     return False
 
+def is_support_object(ob, scene):
+    """visible meshes used as support geometry (i.e. not LuxRender native)"""
+    if ob.type != 'MESH' or not is_object_visible(ob, scene):
+        return False
+
+    # without the LuxRender addon all the visible meshes are support geometry
+    luxrender_mesh = getattr(ob.data, "luxrender_mesh", None)
+    return not luxrender_mesh or luxrender_mesh.type != 'native'
+
+def mesh_world_triangles(object, scene):
+    """(T,3,3) array with the world space triangles of the object (with modifiers)"""
+    mesh = object.to_mesh(scene, True, 'RENDER')
+
+    try:
+        co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get('co', co)
+
+        vertex_index = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get('vertex_index', vertex_index)
+
+        loop_start = np.empty(len(mesh.polygons), dtype=np.int32)
+        loop_total = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get('loop_start', loop_start)
+        mesh.polygons.foreach_get('loop_total', loop_total)
+
+    finally:
+        bpy.data.meshes.remove(mesh)
+
+    # triangle fan of every polygon
+    fan = np.maximum(loop_total - 2, 0)
+    first = np.repeat(loop_start, fan)
+    offset = np.arange(fan.sum()) - np.repeat(np.cumsum(fan) - fan, fan)
+
+    loops = np.column_stack((first, first + offset + 1, first + offset + 2))
+
+    matrix = matrix_to_array(object.matrix_world)
+    verts = co.reshape(-1, 3).dot(matrix[:3, :3].T) + matrix[:3, 3]
+
+    return verts[vertex_index[loops]]
+
+def support_triangles(scene):
+    """(T,3,3) array with the triangles of all the support geometry"""
+    triangles = [mesh_world_triangles(ob, scene) for ob in scene.objects if is_support_object(ob, scene)]
+    if not triangles: return np.empty((0, 3, 3))
+    return np.concatenate(triangles)
+
+def support_bvh(scene):
+    """BVH of all the support geometry, for ray queries"""
+    return BVH.build(support_triangles(scene))
+
 class RENDER_OT_depth(bpy.types.Operator, ExportHelper):
     """"""
     bl_idname = "render.depth"
@@ -204,101 +278,418 @@ class RENDER_OT_depth(bpy.types.Operator, ExportHelper):
     filename_ext = ".exr"
     filter_glob = StringProperty(default="*.exr", options={'HIDDEN'})
 
+    band_height=IntProperty(name="Band Height", description="Panorama rows rendered by each job", default=32, min=1, max=1024)
+    processes=IntProperty(name="Processes", description="Number of render processes, 0 for one per CPU", default=0, min=0, max=256)
+
+    _timer = None
+
     @classmethod
     def poll(cls, context):
+        # no clip editor in background mode, the clip comes from a context override
+        if bpy.app.background:
+            return getattr(context, "edit_movieclip", None) is not None
+
         return context_clip(context)
 
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            return self.cancel(context)
+
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        try:
+            self.write_bands(self.tiles.poll())
+
+        except Exception as error:
+            # stop the workers, close the file and remove the timer and progress bar
+            self.cancel(context)
+            self.report({'ERROR'}, "Depth render failed: {}".format(error))
+            return {'CANCELLED'}
+
+        context.window_manager.progress_update(self.tiles.done)
+
+        if not self.tiles.finished:
+            return {'PASS_THROUGH'}
+
+        return self.complete(context)
+
+    def render_blocking(self, context):
+        """background mode render, there is no window for the modal timer"""
+        try:
+            while not self.tiles.finished:
+                self.write_bands(self.tiles.wait())
+                context.window_manager.progress_update(self.tiles.done)
+
+        except Exception as error:
+            self.cancel(context)
+            self.report({'ERROR'}, "Depth render failed: {}".format(error))
+            return {'CANCELLED'}
+
+        return self.complete(context)
+
+    def write_bands(self, bands):
+        """write the finished bands in file order, from the top down"""
+        for rows, depth in bands:
+            self.pending[rows] = depth
+
+        while self.written < self.tiles.total and self.tiles.bands[self.written] in self.pending:
+            rows = self.tiles.bands[self.written]
+            self.write_band(rows, self.pending.pop(rows))
+            self.written += 1
+
+    def complete(self, context):
+        """close the file once all the bands are written, and use it for the lamp"""
+        self.finish(context)
+        self.writer.close()
+
+        light=bpy.data.objects.get("IBL Light")
+        if light and hasattr(light.data, "luxrender_lamp"):
+            light.data.luxrender_lamp.luxrender_lamp_hemi.infinite_map = self.hdr_filepath
+
+        # 4) set and reset everything
+        settings = bpy.data.movieclips[self.movieclip].ibl_settings
+        settings.hdr_file = self.hdr_filepath
+
+        self.report({'INFO'}, "Image successfully created.\nHDR + Depth Map:{}".format(self.hdr_filepath))
+
+        return {'FINISHED'}
+
     def execute(self, context):
         scene = context.scene
         movieclip = context.edit_movieclip
         settings = movieclip.ibl_settings
-        
+
         # getting the image saved from the calibration operator
         imagepath = settings.hdr_file
         if imagepath == '': imagepath = movieclip.filepath
-        image = get_image(imagepath, fake_user=False)
 
-        if not image:
-            self.report({'ERROR'}, "You need to first set the background from the Movie Clip Editor")
+        # HDR and EXR files are read a band at a time, without loading them in Blender
+        self.reader = get_panorama(imagepath)
+
+        if self.reader:
+            width, height = self.reader.width, self.reader.height
+
+        else:
+            image = get_image(imagepath, fake_user=False)
+
+            if not image:
+                self.report({'ERROR'}, "You need to first set the background from the Movie Clip Editor")
+                return {'CANCELLED'}
+
+            width, height = image.size
+            self.pixels = image_pixels(image)
+
+        # 0) option to saveas
+        self.hdr_filepath = bpy.path.abspath(bpy.path.ensure_ext(self.filepath, self.filename_ext))
+        self.movieclip = movieclip.name
+
+        if self.reader and os.path.exists(self.hdr_filepath) and \
+                os.path.samefile(self.reader.filepath, self.hdr_filepath):
+            self.reader.close()
+            self.report({'ERROR'}, "The depth map can't overwrite the panorama it is read from")
             return {'CANCELLED'}
 
-        light=bpy.data.objects.get("IBL Light")
-        if not light:
-            self.report({'ERROR'}, "You need to first set the background from the Movie Clip Editor")
+        # 1) color from the panorama and depth in the alpha, written as half float RGBA EXR
+        self.writer = imagefile.EXRWriter(self.hdr_filepath, width, height)
+
+        self.pending = {}
+        self.written = 0
+
+        # 2) ray cast the support geometry in latitude bands, in the background
+        self.tiles = tiles.DepthTiles(support_bvh(scene), width, height, \
+                settings.orientation, settings.camera_height, self.band_height, self.processes)
+        self.tiles.start()
+
+        wm = context.window_manager
+        wm.progress_begin(0, self.tiles.total)
+
+        # no timer events without a window (blender -b), wait for the bands here
+        if bpy.app.background or not context.window:
+            return self.render_blocking(context)
+
+        wm.modal_handler_add(self)
+        self._timer = wm.event_timer_add(0.1, context.window)
+
+        return {'RUNNING_MODAL'}
+
+    def write_band(self, rows, depth):
+        """stream a band of the panorama + depth to the file"""
+        width, height = self.writer.width, self.writer.height
+        start, end = rows
+
+        # file rows go from the top down, blender rows from the bottom up
+        if self.reader:
+            color = self.reader.read_rows(height - end, height - start)
+
+        else:
+            color = self.pixels[height - end:height - start]
+
+        band = np.empty((end - start, width, 4), dtype=np.float32)
+        band[:, :, :3] = color[:, :, :3]
+        band[:, :, 3] = depth[::-1]
+
+        self.writer.write(band)
+
+    def cancel(self, context):
+        self.tiles.cancel()
+        self.writer.discard()
+        self.finish(context)
+
+        self.report({'WARNING'}, "Depth render cancelled")
+        return {'CANCELLED'}
+
+    def finish(self, context):
+        """remove the timer and the progress report"""
+        wm = context.window_manager
+        if self._timer:
+            wm.event_timer_remove(self._timer)
+            self._timer = None
+        wm.progress_end()
+
+        if self.reader:
+            self.reader.close()
+
+        self.pixels = None
+
+class RENDER_OT_cubemap(bpy.types.Operator, ExportHelper):
+    """"""
+    bl_idname = "render.cubemap"
+    bl_label = "Export Cubemap"
+    bl_description = "Export the panorama as six cubemap faces (name_px, name_nx, ...)"
+    bl_options = {'REGISTER'}
+
+    filename_ext = ".exr"
+    filter_glob = StringProperty(default="*.exr;*.hdr", options={'HIDDEN'})
+
+    size=IntProperty(name="Face Size", description="Width and height of the faces", default=1024, min=16, max=16384)
+    filter=EnumProperty(name="Filter", items=( \
+            ('AREA', "Area", "Average all the panorama pixels covered by the face pixels"),
+            ('BILINEAR', "Bilinear", "Interpolate the closest panorama pixels"),
+            ), default='AREA')
+
+    @classmethod
+    def poll(cls, context):
+        return context_clip(context)
+
+    def execute(self, context):
+        movieclip = context.edit_movieclip
+        settings = movieclip.ibl_settings
+
+        imagepath = settings.hdr_file
+        if imagepath == '': imagepath = movieclip.filepath
+
+        pixels = panorama_pixels(imagepath)
+        if pixels is None:
+            self.report({'ERROR'}, "Panorama image not found")
             return {'CANCELLED'}
 
-        # 0) option to saveas
-        hdr_filepath = bpy.path.abspath(bpy.path.ensure_ext(self.filepath, self.filename_ext))
-  
-        # 1) create a new scene
-        render_scene = bpy.data.scenes.new(name='lux_render')
-        render_scene.render.resolution_x = image.size[0]
-        render_scene.render.resolution_y = image.size[1]
-        render_scene.render.resolution_percentage = 100
+        faces = cubemap.equirectangular_to_cubemap(pixels[:, :, :3], self.size, self.filter)
 
-        # 2) add all the support objects there
-        for ob in bpy.context.scene.objects:
-            if ob.type == 'MESH':
-                if ob.data.luxrender_mesh.type != 'native' and is_object_visible(ob, scene):
-                    render_scene.objects.link(ob)
-  
-        # 3) create a new camera (equirectangular)
-        camera = bpy.data.objects.new('ibl_camera', bpy.data.cameras.new('ibl_camera'))
-        camera.data.type = 'PANO'
-        camera.location[2] = settings.camera_height
-        camera.rotation_euler = (settings.orientation.to_matrix() * Euler((pi*0.5, 0, -pi*0.5)).to_matrix()).to_euler()
-        render_scene.objects.link(camera)
-        render_scene.camera = camera
-  
-        # 4) change engine to cycles
-        render_scene.render.engine = 'CYCLES'
-        camera.data.cycles.panorama_type = 'EQUIRECTANGULAR'
+        filepath = bpy.path.abspath(bpy.path.ensure_ext(self.filepath, self.filename_ext))
+        root, ext = os.path.splitext(filepath)
 
-        # 5) set renderlayers - depth
-        render_scene.render.layers[0].use_pass_combined = False
-        
-        # 6) create nodes
-        render_scene.use_nodes = True
-        nodetree = render_scene.node_tree
-        
-        zed = nodetree.nodes.get("Render Layers")
-        color = nodetree.nodes.new('IMAGE')
-        color.image = image
+        for name, face in zip(cubemap.FACES, faces):
+            with imagefile.open_writer("{}_{}{}".format(root, name, ext), \
+                    self.size, self.size, ('R', 'G', 'B')) as writer:
+                writer.write(face)
 
-        # Linking - store depth as alpha
-        composite = nodetree.nodes.get("Composite")
-        nodetree.links.new(color.outputs[0], composite.inputs[0])
-        nodetree.links.new(zed.outputs['Z'], composite.inputs[1])
+        self.report({'INFO'}, "Cubemap successfully created: {}_*{}".format(root, ext))
+        return {'FINISHED'}
 
-        # 7) render + composite
-        render_scene.render.filepath = self.filepath
-        render_scene.render.image_settings.file_format = 'OPEN_EXR'
-        render_scene.render.image_settings.color_mode = 'RGBA'
-        render_scene.render.image_settings.color_depth = '16'
-        render_scene.render.image_settings.exr_codec = 'ZIP'
-        render_scene.cycles.samples = 1
-        render_scene.cycles.max_bounces = 0
-        render_scene.cycles.min_bounces = 0
+class RENDER_OT_floor_texture(bpy.types.Operator, ExportHelper):
+    """"""
+    bl_idname = "render.floor_texture"
+    bl_label = "Bake Floor Texture"
+    bl_description = "Bake a top-down orthographic texture of the floor from the calibrated panorama"
+    bl_options = {'REGISTER'}
 
-        # 8) render
-        context.screen.scene = render_scene
-        bpy.ops.render.render()
+    filename_ext = ".exr"
+    filter_glob = StringProperty(default="*.exr;*.hdr", options={'HIDDEN'})
 
-        render = bpy.data.images['Render Result']
-        render.save_render(hdr_filepath, scene=render_scene)
+    extent=FloatVectorProperty(name="Extent", description="Floor area covered by the texture, centered under the camera", size=2, default=(10.0, 10.0), min=0.01, subtype='XYZ')
+    resolution=IntProperty(name="Resolution", description="Texture size along the longest side", default=2048, min=16, max=16384)
 
-        light.data.luxrender_lamp.luxrender_lamp_hemi.infinite_map = hdr_filepath
-        
-        # 11) set and reset everything
-        settings.hdr_file = hdr_filepath
+    @classmethod
+    def poll(cls, context):
+        return context_clip(context)
 
-        context.screen.scene = scene
-        bpy.data.scenes.remove(render_scene)
+    def execute(self, context):
+        movieclip = context.edit_movieclip
+        settings = movieclip.ibl_settings
+
+        imagepath = settings.hdr_file
+        if imagepath == '': imagepath = movieclip.filepath
+
+        pixels = panorama_pixels(imagepath)
+        if pixels is None:
+            self.report({'ERROR'}, "Panorama image not found")
+            return {'CANCELLED'}
+
+        # same pixel size on both axes
+        width, height = self.extent
+        scale = self.resolution / max(width, height)
+        resolution = max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+        texture = bake.floor_texture(pixels[:, :, :3], settings.orientation, settings.camera_height, \
+                (width, height), resolution)
+
+        filepath = bpy.path.abspath(bpy.path.ensure_ext(self.filepath, self.filename_ext))
+        with imagefile.open_writer(filepath, resolution[0], resolution[1], ('R', 'G', 'B')) as writer:
+            writer.write(texture)
+
+        self.report({'INFO'}, "Floor texture successfully created: {}".format(filepath))
+        return {'FINISHED'}
+
+class RENDER_OT_upright_panorama(bpy.types.Operator, ExportHelper):
+    """"""
+    bl_idname = "render.upright_panorama"
+    bl_label = "Export Upright Panorama"
+    bl_description = "Export the panorama with the calibration rotation baked in the pixels"
+    bl_options = {'REGISTER'}
+
+    filename_ext = ".exr"
+    filter_glob = StringProperty(default="*.exr;*.hdr", options={'HIDDEN'})
+
+    band_height=IntProperty(name="Band Height", description="Panorama rows resampled by each job", default=64, min=1, max=1024)
+    threads=IntProperty(name="Threads", description="Number of resampling threads, 0 for one per CPU", default=0, min=0, max=256)
+    cache_size=IntProperty(name="Cache (MB)", description="Memory for the decoded panorama rows, with a strong tilt the rows are decoded again when it is too small", default=bake.CACHE_SIZE >> 20, min=16, max=65536)
+
+    @classmethod
+    def poll(cls, context):
+        return context_clip(context)
+
+    def execute(self, context):
+        movieclip = context.edit_movieclip
+        settings = movieclip.ibl_settings
+
+        imagepath = settings.hdr_file
+        if imagepath == '': imagepath = movieclip.filepath
+
+        filepath = bpy.path.abspath(bpy.path.ensure_ext(self.filepath, self.filename_ext))
+
+        # HDR and EXR files are streamed a band at a time
+        source = get_panorama(imagepath)
+
+        if source:
+            width, height = source.width, source.height
+
+            if os.path.exists(filepath) and os.path.samefile(source.filepath, filepath):
+                source.close()
+                self.report({'ERROR'}, "The upright panorama can't overwrite the panorama it is read from")
+                return {'CANCELLED'}
+
+        else:
+            source = panorama_pixels(imagepath)
+
+            if source is None:
+                self.report({'ERROR'}, "Panorama image not found")
+                return {'CANCELLED'}
+
+            height, width = source.shape[:2]
+
+        wm = context.window_manager
+        wm.progress_begin(0, height)
+
+        try:
+            with imagefile.open_writer(filepath, width, height, ('R', 'G', 'B')) as writer:
+                bake.upright_panorama(source, writer, settings.orientation, \
+                        self.band_height, self.threads, wm.progress_update, self.cache_size << 20)
+
+        finally:
+            wm.progress_end()
+            if hasattr(source, 'close'): source.close()
+
+        self.report({'INFO'}, "Upright panorama successfully created: {}".format(filepath))
+        return {'FINISHED'}
+
+class RENDER_OT_sampling_tables(bpy.types.Operator):
+    """"""
+    bl_idname = "render.sampling_tables"
+    bl_label = "Precompute Sampling Tables"
+    bl_description = "Compute the environment importance sampling tables and cache them next to the HDR file"
+    bl_options = {'REGISTER'}
+
+    width=IntProperty(name="Width", description="Width of the tables, the HDR is downsampled to it", default=sampling.TABLE_WIDTH, min=16, max=16384)
+
+    @classmethod
+    def poll(cls, context):
+        return context_clip(context)
+
+    def execute(self, context):
+        movieclip = context.edit_movieclip
+        settings = movieclip.ibl_settings
+
+        imagepath = settings.hdr_file
+        if imagepath == '': imagepath = movieclip.filepath
+
+        filepath = bpy.path.abspath(imagepath)
+        if os.path.splitext(filepath)[1].lower() not in HDR_EXTENSIONS:
+            self.report({'ERROR'}, "Sampling tables need a Radiance (.hdr) or OpenEXR (.exr) file")
+            return {'CANCELLED'}
+
+        # files the readers can't decode (e.g. PIZ compressed EXR) are read through Blender
+        source = get_panorama(imagepath)
+
+        if not source and not os.path.exists(sampling.tables_path(filepath, self.width)):
+            source = panorama_pixels(imagepath)
 
-        self.report({'INFO'}, "Image successfully created.\nHDR + Depth Map:{}".format(hdr_filepath))
+            if source is None:
+                self.report({'ERROR'}, "Panorama image not found")
+                return {'CANCELLED'}
 
+        try:
+            sampling.load_tables(filepath, self.width, source)
+        finally:
+            if hasattr(source, 'close'): source.close()
+
+        self.report({'INFO'}, "Sampling tables: {}".format(sampling.tables_path(filepath, self.width)))
         return {'FINISHED'}
 
+class RENDER_OT_irradiance(bpy.types.Operator):
+    """"""
+    bl_idname = "render.irradiance"
+    bl_label = "Compute Irradiance"
+    bl_description = "Project the calibrated panorama on spherical harmonics, stored in the scene as 'ibl_irradiance'"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    order=EnumProperty(name="Order", items=( \
+            ('2', "2nd Order", "4 coefficients per channel"),
+            ('3', "3rd Order", "9 coefficients per channel"),
+            ), default='3')
+
+    @classmethod
+    def poll(cls, context):
+        return context_clip(context)
+
+    def execute(self, context):
+        scene = context.scene
+        movieclip = context.edit_movieclip
+        settings = movieclip.ibl_settings
+
+        imagepath = settings.hdr_file
+        if imagepath == '': imagepath = movieclip.filepath
+
+        # the cached float proxy if ready, decoding the HDR otherwise
+        source = get_analysis_pixels(imagepath)
+        if source is None: source = get_panorama(imagepath)
+        if source is None: source = panorama_pixels(imagepath)
+
+        if source is None:
+            self.report({'ERROR'}, "Panorama image not found")
+            return {'CANCELLED'}
+
+        try:
+            coefficients = irradiance.project(source, settings.orientation, int(self.order))
+        finally:
+            if hasattr(source, 'close'): source.close()
+
+        # world space radiance coefficients, (order * order) RGB triplets
+        scene["ibl_irradiance"] = [float(value) for value in coefficients.ravel()]
+
+        floor = irradiance.irradiance(coefficients, ((0.0, 0.0, 1.0),))[0]
+        self.report({'INFO'}, "Floor irradiance: {:.3f} {:.3f} {:.3f}".format(*floor))
+        return {'FINISHED'}
 
 class RENDER_OT_depth_field(bpy.types.Operator, ExportHelper):
     """"""
@@ -455,6 +846,11 @@ class IBLRenderPanel(IBLPanel, bpy.types.Panel):
 
         col = layout.column()
         col.operator("camera.panorama", icon="CAMERA_DATA")
+        col.operator("render.cubemap")
+        col.operator("render.floor_texture")
+        col.operator("render.upright_panorama")
+        col.operator("render.sampling_tables")
+        col.operator("render.irradiance")
         
         if context.scene.render.engine  == 'LUXRENDER_RENDER':
             col.operator("render.depth")
@@ -0,0 +1,191 @@
+"""
+Importance sampling tables of the environment.
+
+Piecewise constant 2D distribution of the panorama luminance, weighted
+by the solid angle of the pixels: the conditional CDF of every row and
+the marginal CDF of the rows. The tables are computed on a downsampled
+copy of the panorama and cached on disk next to the image, keyed by
+its content hash, so renders and farm jobs can skip this preprocessing.
+
+The tables are in the panorama space, the calibration orientation is
+applied to the sampled directions.
+"""
+
+import os
+
+import numpy as np
+
+from . import panorama
+from . import imagefile
+
+# width of the tables, the panorama is box filtered down to it
+TABLE_WIDTH = 1024
+
+# panorama rows decoded at once
+BAND_HEIGHT = 64
+
+# Rec. 709 luminance
+LUMINANCE = (0.2126, 0.7152, 0.0722)
+
+TABLES = ('func', 'conditional_cdf', 'marginal_cdf', 'row_integral', 'integral')
+
+# ###############################
+#  Tables
+# ###############################
+
+def luminance_map(source, width=TABLE_WIDTH):
+    """
+    box filtered luminance of a panorama reader or array, read a band at a time
+    returns a (height, width) float64 array, top row first
+    """
+    pixels = imagefile.read_downsampled(source, width, BAND_HEIGHT)
+    return np.maximum(pixels.dot(LUMINANCE), 0.0)
+
+def build_tables(source, width=TABLE_WIDTH):
+    """
+    sampling tables of a panorama reader or array
+    func : (H,W) luminance times the sine of the polar angle
+    conditional_cdf : (H,W+1) cdf of the columns of every row
+    marginal_cdf : (H+1,) cdf of the rows
+    row_integral : (H,) func integral of every row
+    integral : func integral over the whole [0,1]x[0,1] panorama
+    """
+    func = luminance_map(source, width)
+    height, width = func.shape
+
+    # solid angle of the pixels, from the north pole down
+    theta = (np.arange(height) + 0.5) * (np.pi / height)
+    func *= np.sin(theta)[:, None]
+
+    conditional_cdf = np.zeros((height, width + 1))
+    np.cumsum(func, axis=1, out=conditional_cdf[:, 1:])
+    conditional_cdf /= width
+    row_integral = conditional_cdf[:, -1].copy()
+
+    # black rows are sampled uniformly
+    black = row_integral <= 0.0
+    conditional_cdf[black] = np.linspace(0.0, 1.0, width + 1)
+    conditional_cdf[~black] /= row_integral[~black, None]
+
+    marginal_cdf = np.zeros(height + 1)
+    np.cumsum(row_integral, out=marginal_cdf[1:])
+    marginal_cdf /= height
+    integral = marginal_cdf[-1]
+
+    if integral > 0.0:
+        marginal_cdf /= integral
+    else:
+        marginal_cdf = np.linspace(0.0, 1.0, height + 1)
+
+    return {
+        'func': func.astype(np.float32),
+        'conditional_cdf': conditional_cdf.astype(np.float32),
+        'marginal_cdf': marginal_cdf.astype(np.float32),
+        'row_integral': row_integral.astype(np.float32),
+        'integral': np.float64(integral),
+        }
+
+# ###############################
+#  Disk Cache
+# ###############################
+
+# content hash of the images, by (path, size, mtime)
+_hashes = {}
+
+def tables_path(filepath, width=TABLE_WIDTH):
+    """cache file of the tables, next to the image"""
+    stat = os.stat(filepath)
+    signature = (filepath, stat.st_size, stat.st_mtime)
+
+    # hashing a big HDR is slow, only do it again if the file changed
+    if signature not in _hashes:
+        _hashes[signature] = imagefile.file_hash(filepath)
+
+    root = os.path.splitext(filepath)[0]
+    return "{}.sampling-{}-{}.npz".format(root, _hashes[signature][:16], width)
+
+def load_tables(filepath, width=TABLE_WIDTH, source=None):
+    """
+    sampling tables of the image, computed and cached if needed
+    source : reader or array of the image pixels, read from the file by default
+    """
+    path = tables_path(filepath, width)
+
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return {name: data[name] for name in TABLES}
+
+    if source is not None:
+        tables = build_tables(source, width)
+
+    else:
+        reader = imagefile.open_image(filepath)
+        try:
+            tables = build_tables(reader, width)
+        finally:
+            reader.close()
+
+    # np.savez adds the extension to names without it
+    temp = path[:-len(".npz")] + ".tmp.npz"
+    np.savez(temp, **tables)
+    imagefile.replace_file(temp, path)
+
+    return tables
+
+# ###############################
+#  Sampling
+# ###############################
+
+def sample(tables, u1, u2):
+    """
+    importance sample the panorama with (N,) uniform random numbers
+    returns the (N,2) uv and the pdf with respect to the uv area
+    """
+    marginal_cdf = tables['marginal_cdf']
+    conditional_cdf = tables['conditional_cdf']
+    height, width = tables['func'].shape
+
+    u1 = np.asarray(u1, dtype=np.float64)
+    u2 = np.asarray(u2, dtype=np.float64)
+
+    row = np.clip(np.searchsorted(marginal_cdf, u1, side='right') - 1, 0, height - 1)
+    y = (row + _offset(marginal_cdf[row], marginal_cdf[row + 1], u1)) / height
+
+    # all the rows searched at once, each row shifted above the previous one
+    shifted = (conditional_cdf + 2.0 * np.arange(height)[:, None]).ravel()
+    column = np.searchsorted(shifted, u2 + 2.0 * row, side='right') - 1 - row * (width + 1)
+    column = np.clip(column, 0, width - 1)
+
+    cdf = conditional_cdf[row]
+    x = (column + _offset(cdf[np.arange(len(row)), column], cdf[np.arange(len(row)), column + 1], u2)) / width
+
+    uv = np.empty((len(row), 2))
+    uv[:, 0] = x
+    uv[:, 1] = 1.0 - y
+
+    integral = tables['integral']
+    pdf = tables['func'][row, column] / integral if integral > 0.0 else np.ones(len(row))
+
+    return uv, pdf
+
+def sample_directions(tables, u1, u2, euler=(0.0, 0.0, 0.0)):
+    """
+    importance sample world directions with (N,) uniform random numbers
+    euler : calibration orientation
+    returns the (N,3) directions and the pdf with respect to the solid angle
+    """
+    uv, pdf = sample(tables, u1, u2)
+    verts = panorama.rotate(panorama.equirectangular_to_sphere(uv), panorama.euler_to_matrix(euler))
+
+    # the uv square maps to 2pi x pi, scaled by the sine of the polar angle
+    sin_theta = np.cos((uv[:, 1] - 0.5) * np.pi)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pdf = np.where(sin_theta > 0.0, pdf / (2.0 * np.pi * np.pi * sin_theta), 0.0)
+
+    return verts, pdf
+
+def _offset(low, high, u):
+    """where u is between the cdf values low and high, from 0 to 1"""
+    delta = high - low
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(delta > 0.0, (u - low) / delta, 0.0)
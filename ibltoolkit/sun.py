@@ -0,0 +1,147 @@
+"""
+Sun detection in the panorama.
+
+The brightest region is searched on a pyramid of the downsampled
+panorama, from the coarsest level down, with summed-area tables of the
+luminance weighted by the pixels solid angle: every window energy is
+four lookups. The region found on the finest level gives the sun
+direction, color, irradiance and angular size.
+"""
+
+import numpy as np
+
+from . import panorama
+from . import imagefile
+from .sampling import LUMINANCE
+
+# finest level analysed, the panorama is box filtered down to it
+PYRAMID_WIDTH = 1024
+
+# coarsest level, searched whole
+COARSE_WIDTH = 32
+
+# side of the searched windows, in pixels of every level
+WINDOW = 3
+
+# the sun region is made of the pixels brighter than this fraction of the peak
+THRESHOLD = 0.1
+
+# ###############################
+#  Summed-Area Tables
+# ###############################
+
+def solid_angles(height, width):
+    """(height, 1) solid angle of the pixels of every row, from the top"""
+    theta = (np.arange(height) + 0.5) * (np.pi / height)
+    return (np.sin(theta) * (np.pi / height) * (2.0 * np.pi / width))[:, None]
+
+def pyramid(luminance):
+    """levels halved until COARSE_WIDTH, from the finest to the coarsest"""
+    levels = [luminance]
+
+    while levels[-1].shape[1] > COARSE_WIDTH and levels[-1].shape[0] > 1:
+        level = levels[-1]
+        height, width = level.shape[0] // 2, level.shape[1] // 2
+        levels.append(level[:height * 2, :width * 2].reshape(height, 2, width, 2).mean(axis=(1, 3)))
+
+    return levels
+
+def summed_area_table(values):
+    """(H+1,W+1) summed-area table, with a row and a column of zeros"""
+    table = np.zeros((values.shape[0] + 1, values.shape[1] + 1))
+    np.cumsum(np.cumsum(values, axis=0), axis=1, out=table[1:, 1:])
+    return table
+
+def window_sums(table, size):
+    """sums of all the size x size windows, indexed by their top left pixel"""
+    return table[size:, size:] - table[:-size, size:] - table[size:, :-size] + table[:-size, :-size]
+
+def brightest_window(level, rows=None, columns=None):
+    """
+    top left pixel of the window with most energy (luminance x solid angle)
+    rows, columns : (start, end) range to search, the whole level by default
+    the level wraps around horizontally
+    """
+    height, width = level.shape
+    size = min(WINDOW, height, width)
+
+    energy = level * solid_angles(height, width)
+    energy = np.concatenate((energy, energy[:, :size - 1]), axis=1)
+    sums = window_sums(summed_area_table(energy), size)
+
+    row_start, row_end = rows or (0, len(sums))
+    column_start, column_end = columns or (0, width)
+
+    row_start = max(0, row_start)
+    row_end = min(len(sums), max(row_end, row_start + 1))
+
+    # columns wrap around
+    column_ids = np.arange(column_start, column_end) % width
+    area = sums[row_start:row_end][:, column_ids]
+
+    y, x = np.unravel_index(np.argmax(area), area.shape)
+    return row_start + y, column_ids[x]
+
+# ###############################
+#  Sun Detection
+# ###############################
+
+def find_sun(source, euler=(0.0, 0.0, 0.0), width=PYRAMID_WIDTH):
+    """
+    brightest light of a panorama reader or (height, width, channels) array
+    euler : calibration orientation
+    returns the world direction (towards the sun), the normalized color,
+    the irradiance (at normal incidence) and the angular diameter
+    """
+    pixels = imagefile.read_downsampled(source, width)
+    levels = pyramid(np.maximum(pixels.dot(LUMINANCE), 0.0))
+
+    # coarse to fine, only around the previous level window
+    y, x = brightest_window(levels[-1])
+
+    for level in reversed(levels[:-1]):
+        y, x = brightest_window(level, (2 * y - WINDOW, 2 * y + WINDOW + 1), (2 * x - WINDOW, 2 * x + WINDOW + 1))
+
+    luminance = levels[0]
+    height, width = luminance.shape
+    size = min(WINDOW, height, width)
+
+    # peak of the window, then the bright pixels around it
+    rows = np.arange(y, y + size) % height
+    columns = np.arange(x, x + size) % width
+    window = luminance[rows][:, columns]
+    peak_y, peak_x = np.unravel_index(np.argmax(window), window.shape)
+    peak = window[peak_y, peak_x]
+
+    radius = 4 * WINDOW
+    rows = np.clip(np.arange(y + peak_y - radius, y + peak_y + radius + 1), 0, height - 1)
+    rows = np.unique(rows)
+
+    # the columns narrow towards the poles, a disk spans 1 / sin(theta) times more of them
+    theta = (rows + 0.5) * (np.pi / height)
+    column_radius = min(int(np.ceil(radius / np.sin(theta).min())), (width - 1) // 2)
+    columns = np.arange(x + peak_x - column_radius, x + peak_x + column_radius + 1) % width
+
+    region = luminance[rows][:, columns]
+    mask = region >= peak * THRESHOLD
+    weights = (region * solid_angles(height, width)[rows]) * mask
+
+    # direction, luminance weighted
+    uv = np.empty((len(rows), len(columns), 2))
+    uv[:, :, 0] = ((columns + 0.5) / width)[None, :]
+    uv[:, :, 1] = (1.0 - (rows + 0.5) / height)[:, None]
+    verts = panorama.equirectangular_to_sphere(uv.reshape(-1, 2))
+
+    direction = panorama.normalize((verts * weights.reshape(-1, 1)).sum(axis=0)[None])[0]
+    direction = panorama.rotate(direction[None], panorama.euler_to_matrix(euler))[0]
+
+    solid_angle = (solid_angles(height, width)[rows] * mask).sum()
+    irradiance = weights.sum()
+
+    color = (pixels[rows][:, columns] * mask[:, :, None]).sum(axis=(0, 1))
+    color = color / color.max() if color.max() > 0.0 else np.ones(3)
+
+    # angular diameter of the cone with the same solid angle
+    angle = 2.0 * np.arccos(1.0 - min(solid_angle, 4.0 * np.pi) / (2.0 * np.pi))
+
+    return direction, color, irradiance, angle
@@ -0,0 +1,224 @@
+"""
+Tiled multi-process rendering of panorama sized jobs.
+
+The panorama is split in latitude bands which are rendered by a process
+pool. The geometry is written once to temporary files which every worker
+memory-maps (read only, shared through the page cache), the bands come
+back as they are finished.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+from . import raycast
+from .bvh import BVH
+
+def cpu_count():
+    """number of cpus, 1 if it can't be found"""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+# ###############################
+#  Worker Side
+# ###############################
+
+# per worker process state, the geometry mapped by _render_band
+_worker = {}
+
+def map_arrays(specs):
+    """memory-map the shared arrays, read only"""
+    arrays = {}
+    for name, (path, shape, dtype) in specs.items():
+        if path:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', shape=shape)
+        else:
+            # empty arrays have no file, mmap can't map zero bytes
+            arrays[name] = np.empty(shape, dtype=dtype)
+
+    return arrays
+
+def _render_band(specs, job, rows):
+    """depth of a band of rows, runs in the worker"""
+    # the geometry is mapped by the first band the worker gets
+    if _worker.get('specs') != specs:
+        _worker['geometry'] = BVH(**map_arrays(specs))
+        _worker['specs'] = specs
+
+    return render_band(_worker['geometry'], job, rows)
+
+def render_band(geometry, job, rows):
+    """returns the rows and their depth"""
+    width, height, euler, camera_height = job
+    return rows, raycast.render_depth(geometry, width, height, euler, camera_height, rows)
+
+# ###############################
+#  Scheduler
+# ###############################
+
+def run_threaded(function, jobs, threads=None):
+    """
+    call function(*job) for every job on a thread pool
+    for numpy heavy jobs, numpy releases the GIL while working
+    """
+    with ThreadPoolExecutor(threads or cpu_count()) as executor:
+        # consume the results to raise the workers exceptions
+        for result in executor.map(lambda job: function(*job), jobs):
+            pass
+
+def map_threaded(function, jobs, threads=None, ahead=None):
+    """
+    generator of function(*job) for every job, in order, computed on a thread pool
+    ahead : jobs submitted ahead of the consumer, 2 * threads by default,
+    bounds the results (and their memory) waiting to be consumed
+    """
+    threads = threads or cpu_count()
+    ahead = ahead or 2 * threads
+
+    with ThreadPoolExecutor(threads) as executor:
+        futures = deque()
+
+        for job in jobs:
+            futures.append(executor.submit(function, *job))
+
+            if len(futures) > ahead:
+                yield futures.popleft().result()
+
+        while futures:
+            yield futures.popleft().result()
+
+def latitude_bands(height, band_height):
+    """
+    (start, end) row ranges covering the panorama, from the top row down
+    rows are counted from the bottom like in Blender
+    """
+    bands = []
+    for end in range(height, 0, -band_height):
+        bands.append((max(0, end - band_height), end))
+    return bands
+
+def fork_pool(processes):
+    """process pool with forked workers, None where the workers can't import the addon"""
+    if sys.version_info >= (3, 7):
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            return None
+        return ProcessPoolExecutor(processes, multiprocessing.get_context('fork'))
+
+    # older pools use the default start method, always fork on posix
+    if os.name != 'posix':
+        return None
+    return ProcessPoolExecutor(processes)
+
+class DepthTiles:
+    """
+    render the panorama depth in latitude bands on a process pool
+
+    start() launches all the bands, poll() returns the ones that are
+    done since the last call (wait() blocks until there are some),
+    cancel() drops the remaining ones.
+    """
+    def __init__(self, geometry, width, height, euler, camera_height, band_height=32, processes=None):
+        self.geometry = geometry
+        self.job = (width, height, tuple(euler), camera_height)
+        self.bands = latitude_bands(height, band_height)
+        self.processes = processes or cpu_count()
+
+        self._directory = None
+        self._executor = None
+        self._futures = []
+        self.done = 0
+
+    @property
+    def total(self):
+        return len(self.bands)
+
+    @property
+    def finished(self):
+        return self.done == self.total
+
+    def start(self):
+        """share the geometry and submit all the bands"""
+        self._executor = fork_pool(self.processes)
+
+        if self._executor:
+            specs = self._share(self.geometry.arrays())
+            self._futures = [self._executor.submit(_render_band, specs, self.job, rows) \
+                    for rows in self.bands]
+
+        else:
+            # the workers can't import the addon without Blender, numpy releases the GIL instead
+            self._executor = ThreadPoolExecutor(self.processes)
+            self._futures = [self._executor.submit(render_band, self.geometry, self.job, rows) \
+                    for rows in self.bands]
+
+    def poll(self):
+        """
+        list of (rows, depth) for the bands finished since the last call
+        raises the exception of a failed band, call cancel() then
+        """
+        bands = []
+        pending = []
+        for future in self._futures:
+            if future.done():
+                bands.append(future.result())
+            else:
+                pending.append(future)
+
+        self._futures = pending
+        self.done += len(bands)
+
+        if self.finished:
+            self.close()
+
+        return bands
+
+    def wait(self, timeout=None):
+        """poll(), blocking until a band is done or the timeout (in seconds)"""
+        if self._futures:
+            wait(self._futures, timeout, FIRST_COMPLETED)
+
+        return self.poll()
+
+    def cancel(self):
+        """drop the pending bands, the running ones are left to finish on their own"""
+        for future in self._futures:
+            future.cancel()
+
+        self._futures = []
+        self.close(wait=False)
+
+    def close(self, wait=True):
+        """shutdown the pool and remove the shared geometry files"""
+        if self._executor:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+        # the workers still mapping them keep the data until they exit
+        if self._directory:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+    def _share(self, arrays):
+        """write the arrays to temporary files, returns the specs to map them"""
+        self._directory = tempfile.mkdtemp(prefix="ibl_depth_")
+
+        specs = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            path = None
+
+            if array.size:
+                path = os.path.join(self._directory, "{}.bin".format(name))
+                array.tofile(path)
+
+            specs[name] = (path, array.shape, array.dtype.str)
+
+        return specs